@@ -9,11 +9,11 @@ from datetime import datetime, date
 from enum import Enum
 
 from fastapi import APIRouter, HTTPException, Depends, status
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field, validator
 
 from src.core.config import settings
 from src.services.sop_service import sop_generator, SOPContext
-from src.services.gemini_service import gemini_service
 from src.services.form_service import form_service, FormType
 
 router = APIRouter()
@@ -365,6 +365,33 @@ async def submit_complete_questionnaire(session_id: str, request: QuestionnaireR
         )
 
 
+def _sample_sop_context() -> SOPContext:
+    """Sample SOP context used until sessions are persisted."""
+    return SOPContext(
+        full_name="John Doe",
+        age=21,
+        nationality="Indian",
+        current_location="Mumbai, India",
+        highest_qualification="Bachelor's Degree",
+        institution_name="University of Mumbai",
+        graduation_year=2024,
+        gpa_percentage=85.0,
+        field_of_study="Computer Science",
+        program_name="Master of Computer Science",
+        institution_canada="University of Toronto",
+        program_duration="2 years",
+        intake_term="Fall 2024",
+        tuition_fees=45000.0,
+        work_experience_years=0,
+        total_funds_available=75000.0,
+        funding_source="Family savings and GIC",
+        career_goals="To become a software engineer and contribute to AI research",
+        return_intention="To return to India and start my own tech company",
+        how_program_helps="This program will provide advanced knowledge in AI and machine learning",
+        ties_to_home_country="Strong family ties and property ownership in India"
+    )
+
+
 @router.post("/generate-sop/{session_id}")
 async def generate_sop_from_questionnaire(session_id: str):
     """Generate SOP based on questionnaire responses."""
@@ -373,29 +400,7 @@ async def generate_sop_from_questionnaire(session_id: str):
         # For now, return a sample response
         
         # Create sample SOP context from questionnaire
-        sample_context = SOPContext(
-            full_name="John Doe",
-            age=21,
-            nationality="Indian",
-            current_location="Mumbai, India",
-            highest_qualification="Bachelor's Degree",
-            institution_name="University of Mumbai",
-            graduation_year=2024,
-            gpa_percentage=85.0,
-            field_of_study="Computer Science",
-            program_name="Master of Computer Science",
-            institution_canada="University of Toronto",
-            program_duration="2 years",
-            intake_term="Fall 2024",
-            tuition_fees=45000.0,
-            work_experience_years=0,
-            total_funds_available=75000.0,
-            funding_source="Family savings and GIC",
-            career_goals="To become a software engineer and contribute to AI research",
-            return_intention="To return to India and start my own tech company",
-            how_program_helps="This program will provide advanced knowledge in AI and machine learning",
-            ties_to_home_country="Strong family ties and property ownership in India"
-        )
+        sample_context = _sample_sop_context()
         
         # Generate SOP
         sop_result = await sop_generator.generate_sop(sample_context, "standard")
@@ -417,6 +422,45 @@ async def generate_sop_from_questionnaire(session_id: str):
         )
 
 
+@router.post("/generate-sop/{session_id}/stream")
+async def stream_sop_from_questionnaire(session_id: str):
+    """Stream the SOP to the client section by section as it is generated."""
+    try:
+        sample_context = _sample_sop_context()
+        sop_generator.validate_context(sample_context)
+        
+        return StreamingResponse(
+            sop_generator.stream_sop(sample_context, "standard"),
+            media_type="text/plain"
+        )
+        
+    except Exception as e:
+        logger.error(f"Failed to stream SOP: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to stream SOP: {str(e)}"
+        )
+
+
+@router.post("/generate-sop/{session_id}/text")
+async def render_sop_text(session_id: str):
+    """Return the SOP as plain text, sent from pre-encoded bytes."""
+    try:
+        sample_context = _sample_sop_context()
+        
+        return Response(
+            content=sop_generator.render_sop_bytes(sample_context),
+            media_type="text/plain; charset=utf-8"
+        )
+        
+    except Exception as e:
+        logger.error(f"Failed to render SOP text: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to render SOP text: {str(e)}"
+        )
+
+
 @router.get("/document-checklist/{session_id}", response_model=DocumentChecklist)
 async def get_document_checklist(session_id: str):
     """Get document checklist for the session."""
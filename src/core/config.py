@@ -72,6 +72,7 @@ class Settings:
     GEMINI_MODEL: str = "gemini-1.5-pro"
     GEMINI_TEMPERATURE: float = 0.7
     GEMINI_MAX_TOKENS: int = 8192
+    GEMINI_MAX_CONCURRENCY: int = 10
     
     # Fallback AI Configuration
     OPENAI_API_KEY: str = ""
@@ -117,6 +118,8 @@ class Settings:
     SOP_MIN_WORDS: int = 800
     SOP_MAX_WORDS: int = 1500
     SOP_TARGET_READABILITY: float = 60.0  # Flesch Reading Ease score
+    SOP_CACHE_TTL_SECONDS: int = 3600
+    SOP_CACHE_MAX_ENTRIES: int = 256
     
     # Document Processing
     MAX_FILE_SIZE_MB: int = 10
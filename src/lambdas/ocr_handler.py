@@ -6,12 +6,29 @@ Handles document text extraction and publishes results to SNS topic.
 import json
 import boto3
 import os
+import re
 import uuid
 import logging
-from typing import Dict, Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from functools import partial
+from typing import Callable, Dict, Any, List, Optional
 from datetime import datetime
 import base64
 
+try:
+    import orjson
+    
+    def _dumps(obj: Any, indent: bool = False) -> str:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_INDENT_2 if indent else 0).decode()
+    
+    _loads = orjson.loads
+except ImportError:  # orjson is optional in the Lambda asset; fall back to the stdlib codec
+    def _dumps(obj: Any, indent: bool = False) -> str:
+        return json.dumps(obj, default=str, indent=2 if indent else None)
+    
+    _loads = json.loads
+
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -32,9 +49,44 @@ TABLE_ANSWERS = os.environ.get('TABLE_ANSWERS', 'visamate-ai-wizardanswers')
 # Constants
 MAX_FILE_SIZE_MB = 5
 MAX_PAGES_SYNC = 5
+MAX_NOTIFY_WORKERS = 10
 SUPPORTED_IMAGE_FORMATS = ['.jpg', '.jpeg', '.png', '.tiff', '.tif']
 SUPPORTED_DOC_FORMATS = ['.pdf']
 
+# Field extraction patterns, compiled once per container rather than per record
+_AMOUNT = r'(?:cad|can\$|\$)?\s*(\d+(?:,\d{3})*(?:\.\d{2})?)'
+PASSPORT_NUMBER_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'passport\s*(?:no|number|#)?\s*:?\s*([A-Z0-9]{6,9})',
+    r'passport\s*([A-Z0-9]{6,9})',
+    r'([A-Z]{1,2}[0-9]{6,8})'
+))
+FULL_NAME_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'name\s*:?\s*([A-Za-z\s]{2,50})',
+    r'applicant\s*:?\s*([A-Za-z\s]{2,50})',
+    r'student\s*:?\s*([A-Za-z\s]{2,50})'
+))
+DATE_OF_BIRTH_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'(?:date\s*of\s*birth|dob|birth\s*date)\s*:?\s*(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})',
+    r'(?:born|birth)\s*:?\s*(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})',
+    r'(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})'
+))
+IELTS_SCORE_PATTERNS = tuple(
+    (name, re.compile(name + r'\s*:?\s*(\d+\.?\d*)', re.IGNORECASE))
+    for name in ('listening', 'reading', 'writing', 'speaking', 'overall')
+)
+INSTITUTION_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'(?:university|college|institute|school)\s*(?:of|at)?\s*([A-Za-z\s]{2,50})',
+    r'([A-Za-z\s]{2,50})\s*(?:university|college|institute)',
+))
+GIC_AMOUNT_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'gic\s*(?:amount)?\s*:?\s*' + _AMOUNT,
+    r'guaranteed\s*investment\s*certificate\s*:?\s*' + _AMOUNT
+))
+TUITION_AMOUNT_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'tuition\s*(?:fee|fees)?\s*:?\s*' + _AMOUNT,
+    r'program\s*fee\s*:?\s*' + _AMOUNT
+))
+
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -48,13 +100,15 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         Processing result dictionary
     """
     try:
-        logger.info(f"Received event: {json.dumps(event, default=str)}")
+        logger.info(f"Received event: {_dumps(event)}")
         
-        # Process each SQS record
+        # Process each SQS record; the SNS completion notification of each
+        # document is deferred to one concurrent flush
         results = []
+        pending: List[Callable[[], None]] = []
         for record in event.get('Records', []):
             try:
-                result = process_sqs_record(record)
+                result = process_sqs_record(record, pending)
                 results.append(result)
             except Exception as e:
                 logger.error(f"Failed to process record: {str(e)}")
@@ -64,9 +118,11 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'record_id': record.get('messageId', 'unknown')
                 })
         
+        publish_pending_notifications(pending)
+        
         return {
             'statusCode': 200,
-            'body': json.dumps({
+            'body': _dumps({
                 'message': f'Processed {len(results)} records',
                 'results': results
             })
@@ -76,25 +132,27 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         logger.error(f"Lambda handler error: {str(e)}")
         return {
             'statusCode': 500,
-            'body': json.dumps({
+            'body': _dumps({
                 'error': str(e)
             })
         }
 
 
-def process_sqs_record(record: Dict[str, Any]) -> Dict[str, Any]:
+def process_sqs_record(record: Dict[str, Any], pending: Optional[List[Callable[[], None]]] = None) -> Dict[str, Any]:
     """
     Process a single SQS record containing S3 event notification.
     
     Args:
         record: SQS record with S3 event data
+        pending: If given, the document's completion notification is
+            appended here instead of being published immediately
         
     Returns:
         Processing result
     """
     try:
         # Parse S3 event from SQS message
-        message_body = json.loads(record['body'])
+        message_body = _loads(record['body'])
         
         # Handle S3 event notification format
         if 'Records' in message_body:
@@ -140,9 +198,6 @@ def process_sqs_record(record: Dict[str, Any]) -> Dict[str, Any]:
         # Save OCR results to S3
         json_key = save_ocr_results_to_s3(ocr_result, document_id)
         
-        # Update document with OCR results
-        update_document_with_ocr_results(document_id, ocr_result, json_key)
-        
         # Map OCR results to questionnaire fields
         mapped_data = map_ocr_to_questionnaire_fields(ocr_result)
         
@@ -150,8 +205,15 @@ def process_sqs_record(record: Dict[str, Any]) -> Dict[str, Any]:
         if mapped_data:
             update_wizard_answers(document_id, mapped_data)
         
-        # Publish completion notification
-        publish_ocr_complete_notification(document_id, ocr_result, mapped_data)
+        # Record the OCR results before announcing them, so subscribers never
+        # see the notification before the document is marked processed
+        update_document_with_ocr_results(document_id, ocr_result, json_key)
+        
+        notify = partial(publish_ocr_complete_notification, document_id, ocr_result, mapped_data)
+        if pending is None:
+            notify()
+        else:
+            pending.append(notify)
         
         return {
             'status': 'success',
@@ -420,22 +482,14 @@ def map_ocr_to_questionnaire_fields(ocr_result: Dict[str, Any]) -> Dict[str, Any
 
 def extract_passport_number(text: str, form_data: Dict[str, Any]) -> Optional[str]:
     """Extract passport number from text."""
-    import re
-    
     # Look in form data first
     for key, value in form_data.items():
         if 'passport' in key.lower() and 'number' in key.lower():
             return value
     
     # Pattern matching for common passport number formats
-    patterns = [
-        r'passport\s*(?:no|number|#)?\s*:?\s*([A-Z0-9]{6,9})',
-        r'passport\s*([A-Z0-9]{6,9})',
-        r'([A-Z]{1,2}[0-9]{6,8})'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in PASSPORT_NUMBER_PATTERNS:
+        match = pattern.search(text)
         if match:
             return match.group(1).upper()
     
@@ -451,15 +505,8 @@ def extract_full_name(text: str, form_data: Dict[str, Any]) -> Optional[str]:
                 return value.title()
     
     # Pattern matching for names
-    import re
-    patterns = [
-        r'name\s*:?\s*([A-Za-z\s]{2,50})',
-        r'applicant\s*:?\s*([A-Za-z\s]{2,50})',
-        r'student\s*:?\s*([A-Za-z\s]{2,50})'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in FULL_NAME_PATTERNS:
+        match = pattern.search(text)
         if match:
             name = match.group(1).strip().title()
             if len(name.split()) >= 2:
@@ -470,22 +517,14 @@ def extract_full_name(text: str, form_data: Dict[str, Any]) -> Optional[str]:
 
 def extract_date_of_birth(text: str, form_data: Dict[str, Any]) -> Optional[str]:
     """Extract date of birth from text."""
-    import re
-    
     # Look in form data first
     for key, value in form_data.items():
         if 'birth' in key.lower() or 'dob' in key.lower():
             return value
     
     # Pattern matching for dates
-    date_patterns = [
-        r'(?:date\s*of\s*birth|dob|birth\s*date)\s*:?\s*(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})',
-        r'(?:born|birth)\s*:?\s*(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})',
-        r'(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})'
-    ]
-    
-    for pattern in date_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in DATE_OF_BIRTH_PATTERNS:
+        match = pattern.search(text)
         if match:
             return match.group(1)
     
@@ -500,7 +539,6 @@ def extract_nationality(text: str, form_data: Dict[str, Any]) -> Optional[str]:
             return value
     
     # Common nationality patterns
-    import re
     countries = ['indian', 'chinese', 'canadian', 'american', 'british', 'australian', 'german', 'french']
     
     for country in countries:
@@ -512,24 +550,12 @@ def extract_nationality(text: str, form_data: Dict[str, Any]) -> Optional[str]:
 
 def extract_ielts_scores(text: str, form_data: Dict[str, Any]) -> Optional[Dict[str, float]]:
     """Extract IELTS scores from text."""
-    import re
-    
     scores = {}
     
-    # Pattern for IELTS scores
-    score_patterns = [
-        r'listening\s*:?\s*(\d+\.?\d*)',
-        r'reading\s*:?\s*(\d+\.?\d*)',
-        r'writing\s*:?\s*(\d+\.?\d*)',
-        r'speaking\s*:?\s*(\d+\.?\d*)',
-        r'overall\s*:?\s*(\d+\.?\d*)'
-    ]
-    
-    for i, pattern in enumerate(score_patterns):
-        match = re.search(pattern, text, re.IGNORECASE)
+    for name, pattern in IELTS_SCORE_PATTERNS:
+        match = pattern.search(text)
         if match:
-            score_names = ['listening', 'reading', 'writing', 'speaking', 'overall']
-            scores[score_names[i]] = float(match.group(1))
+            scores[name] = float(match.group(1))
     
     return scores if scores else None
 
@@ -542,14 +568,8 @@ def extract_institution_name(text: str, form_data: Dict[str, Any]) -> Optional[s
             return value
     
     # Pattern matching for institutions
-    import re
-    patterns = [
-        r'(?:university|college|institute|school)\s*(?:of|at)?\s*([A-Za-z\s]{2,50})',
-        r'([A-Za-z\s]{2,50})\s*(?:university|college|institute)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in INSTITUTION_PATTERNS:
+        match = pattern.search(text)
         if match:
             return match.group(1).strip().title()
     
@@ -568,16 +588,9 @@ def extract_program_name(text: str, form_data: Dict[str, Any]) -> Optional[str]:
 
 def extract_gic_amount(text: str, form_data: Dict[str, Any]) -> Optional[float]:
     """Extract GIC amount from text."""
-    import re
-    
     # Look for GIC amounts
-    patterns = [
-        r'gic\s*(?:amount)?\s*:?\s*(?:cad|can\$|\$)?\s*(\d+(?:,\d{3})*(?:\.\d{2})?)',
-        r'guaranteed\s*investment\s*certificate\s*:?\s*(?:cad|can\$|\$)?\s*(\d+(?:,\d{3})*(?:\.\d{2})?)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in GIC_AMOUNT_PATTERNS:
+        match = pattern.search(text)
         if match:
             amount_str = match.group(1).replace(',', '')
             return float(amount_str)
@@ -587,16 +600,9 @@ def extract_gic_amount(text: str, form_data: Dict[str, Any]) -> Optional[float]:
 
 def extract_tuition_amount(text: str, form_data: Dict[str, Any]) -> Optional[float]:
     """Extract tuition amount from text."""
-    import re
-    
     # Look for tuition amounts
-    patterns = [
-        r'tuition\s*(?:fee|fees)?\s*:?\s*(?:cad|can\$|\$)?\s*(\d+(?:,\d{3})*(?:\.\d{2})?)',
-        r'program\s*fee\s*:?\s*(?:cad|can\$|\$)?\s*(\d+(?:,\d{3})*(?:\.\d{2})?)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in TUITION_AMOUNT_PATTERNS:
+        match = pattern.search(text)
         if match:
             amount_str = match.group(1).replace(',', '')
             return float(amount_str)
@@ -618,7 +624,7 @@ def save_ocr_results_to_s3(ocr_result: Dict[str, Any], document_id: str) -> str:
         s3_client.put_object(
             Bucket=bucket_name,
             Key=json_key,
-            Body=json.dumps(ocr_result, default=str, indent=2),
+            Body=_dumps(ocr_result, indent=True),
             ContentType='application/json'
         )
         
@@ -630,6 +636,17 @@ def save_ocr_results_to_s3(ocr_result: Dict[str, Any], document_id: str) -> str:
         return ''
 
 
+def to_dynamodb_value(value: Any) -> Any:
+    """Convert floats, including nested ones, to Decimal for the DynamoDB serializer."""
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: to_dynamodb_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamodb_value(v) for v in value]
+    return value
+
+
 def update_document_status(document_id: str, status: str, additional_data: Dict[str, Any] = None) -> None:
     """Update document status in DynamoDB."""
     try:
@@ -645,7 +662,7 @@ def update_document_status(document_id: str, status: str, additional_data: Dict[
         if additional_data:
             for key, value in additional_data.items():
                 update_expression += f", {key} = :{key}"
-                expression_attribute_values[f":{key}"] = value
+                expression_attribute_values[f":{key}"] = to_dynamodb_value(value)
         
         table.update_item(
             Key={'document_id': document_id},
@@ -701,6 +718,20 @@ def update_wizard_answers(document_id: str, mapped_data: Dict[str, Any]) -> None
         logger.error(f"Failed to update wizard answers: {str(e)}")
 
 
+def publish_pending_notifications(pending: List[Callable[[], None]]) -> None:
+    """Publish the deferred completion notifications of a batch concurrently."""
+    if len(pending) <= 1:
+        for notify in pending:
+            notify()
+        return
+    
+    # Only the low-level SNS client is shared across threads (boto3 clients are
+    # thread-safe, resources are not); DynamoDB updates stay on the handler
+    # thread. Each notification logs its own failures.
+    with ThreadPoolExecutor(max_workers=min(MAX_NOTIFY_WORKERS, len(pending))) as executor:
+        list(executor.map(lambda notify: notify(), pending))
+
+
 def publish_ocr_complete_notification(document_id: str, ocr_result: Dict[str, Any], mapped_data: Dict[str, Any]) -> None:
     """Publish OCR completion notification to SNS."""
     try:
@@ -722,7 +753,7 @@ def publish_ocr_complete_notification(document_id: str, ocr_result: Dict[str, An
         
         sns_client.publish(
             TopicArn=SNS_OCR_TOPIC,
-            Message=json.dumps(message, default=str),
+            Message=_dumps(message),
             Subject=f'OCR Processing Complete - Document {document_id}'
         )
         
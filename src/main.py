@@ -22,7 +22,7 @@ from src.api.v1.wizard import router as wizard_router
 from src.api.v1.documents import router as documents_router
 from src.api.v1.documents_simple import router as documents_simple_router
 from src.api.v1.health import router as health_router
-from src.services.gemini_service import gemini_service
+from src.services.gemini_service import close_gemini_service
 
 # Configure logging
 logging.basicConfig(
@@ -103,6 +103,7 @@ async def cleanup_resources():
     try:
         # Close any open connections, clear caches, etc.
         logger.info("Cleaning up resources...")
+        await close_gemini_service()
         
     except Exception as e:
         logger.error(f"Error during cleanup: {str(e)}")
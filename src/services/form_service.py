@@ -4,10 +4,11 @@ Handles auto-population of Canadian immigration forms based on questionnaire res
 """
 
 import logging
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, FrozenSet, Iterator, List, Optional
 from datetime import datetime, date
 from dataclasses import dataclass, field
 from enum import Enum
+from functools import cached_property, lru_cache
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +39,11 @@ class FormSection:
     section_name: str
     fields: List[FormField] = field(default_factory=list)
     instructions: Optional[str] = None
+    
+    @cached_property
+    def fields_by_id(self) -> Dict[str, FormField]:
+        """Index of the section's fields keyed by field_id."""
+        return {f.field_id: f for f in self.fields}
 
 
 @dataclass
@@ -51,6 +57,20 @@ class IRCCForm:
     is_valid: bool = False
     validation_errors: List[str] = field(default_factory=list)
     generated_at: datetime = field(default_factory=datetime.utcnow)
+    
+    @cached_property
+    def sections_by_id(self) -> Dict[str, FormSection]:
+        """Index of the form's sections keyed by section_id."""
+        return {s.section_id: s for s in self.sections}
+    
+    @cached_property
+    def field_types(self) -> FrozenSet[str]:
+        """Distinct field types used across the form's sections."""
+        return frozenset(f.field_type for s in self.sections for f in s.fields)
+    
+    def iter_filled_fields(self) -> Iterator[FormField]:
+        """Yield every field across the form's sections that has a value."""
+        return (f for s in self.sections for f in s.fields if f.value)
 
 
 class FormAutoFillService:
@@ -74,8 +94,10 @@ class FormAutoFillService:
         
         return templates
     
-    def _create_imm1294_template(self) -> IRCCForm:
-        """Create IMM1294 form template."""
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def _create_imm1294_template() -> IRCCForm:
+        """Create IMM1294 form template, built once and shared as a read-only prototype."""
         sections = [
             FormSection(
                 section_id="personal_details",
@@ -168,8 +190,10 @@ class FormAutoFillService:
             sections=sections
         )
     
-    def _create_imm5645_template(self) -> IRCCForm:
-        """Create IMM5645 form template."""
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def _create_imm5645_template() -> IRCCForm:
+        """Create IMM5645 form template, built once and shared as a read-only prototype."""
         sections = [
             FormSection(
                 section_id="applicant_info",
@@ -202,8 +226,10 @@ class FormAutoFillService:
             sections=sections
         )
     
-    def _create_imm5257_template(self) -> IRCCForm:
-        """Create IMM5257 form template."""
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def _create_imm5257_template() -> IRCCForm:
+        """Create IMM5257 form template, built once and shared as a read-only prototype."""
         sections = [
             FormSection(
                 section_id="personal_details",
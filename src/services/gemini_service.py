@@ -4,178 +4,85 @@ Provides advanced AI capabilities for SOP generation and document analysis.
 """
 
 import asyncio
-import json
 import logging
-from typing import Dict, Any, List, Optional
-from datetime import datetime
+from typing import Dict, Any, List, Optional, AsyncIterator, Iterator, Tuple
+from string import Formatter, Template
+from functools import lru_cache
 import re
 
+import httpx
+
 from src.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+_GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
 
-class GeminiService:
-    """Google Gemini AI service for SOP generation and content analysis."""
-    
-    def __init__(self):
-        """Initialize Gemini service with API key and configuration."""
-        self.api_key = settings.GEMINI_API_KEY
-        self.model = settings.GEMINI_MODEL
-        self.temperature = settings.GEMINI_TEMPERATURE
-        self.max_tokens = settings.GEMINI_MAX_TOKENS
-    
-    async def generate_sop(self, context: Dict[str, Any], template_type: str = "standard") -> str:
-        """Generate a comprehensive Statement of Purpose using Gemini."""
-        try:
-            prompt = self._build_sop_prompt(context, template_type)
-            
-            # Mock implementation - replace with actual Gemini API call
-            await asyncio.sleep(0.5)  # Simulate API call
-            return self._generate_production_sop(context, template_type)
-                
-        except Exception as e:
-            logger.error(f"Gemini SOP generation failed: {str(e)}")
-            return self._generate_production_sop(context, template_type)
-    
-    def _build_sop_prompt(self, context: Dict[str, Any], template_type: str) -> str:
-        """Build a comprehensive prompt for SOP generation."""
-        
-        # Extract key information
-        personal_info = self._extract_personal_info(context)
-        academic_info = self._extract_academic_info(context)
-        program_info = self._extract_program_info(context)
-        financial_info = self._extract_financial_info(context)
-        career_info = self._extract_career_info(context)
-        
-        base_prompt = f"""
-You are an expert immigration consultant specializing in Canada study visa applications. 
-Generate a compelling, authentic, and professional Statement of Purpose (SOP) for a Canada study visa application.
+# Retry policy for rate limiting (429) and overload (503) responses
+_GEMINI_RETRY_STATUSES = frozenset({429, 503})
+_GEMINI_MAX_RETRIES = 3
+_GEMINI_RETRY_BASE_DELAY = 1.0
 
-CRITICAL REQUIREMENTS:
-- Word count: {settings.SOP_MIN_WORDS}-{settings.SOP_MAX_WORDS} words
-- Tone: Professional, sincere, and confident
-- Structure: Clear sections with smooth transitions
-- Content: Specific, detailed, and personalized
-- Compliance: Address all visa officer concerns
+# Control characters (except tab/newline/carriage return) stripped from applicant text
+_CTRL_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_sanitize = _CTRL_RE.sub
 
-APPLICANT PROFILE:
-{personal_info}
 
-ACADEMIC BACKGROUND:
-{academic_info}
-
-PROPOSED STUDY:
-{program_info}
-
-FINANCIAL CAPACITY:
-{financial_info}
-
-CAREER GOALS:
-{career_info}
-
-Generate a compelling SOP that will convince visa officers of genuine intent.
-"""
-        
-        return base_prompt
-    
-    def _extract_personal_info(self, context: Dict[str, Any]) -> str:
-        """Extract and format personal information."""
-        return f"""
-Name: {context.get('full_name', 'N/A')}
-Age: {context.get('age', 'N/A')}
-Nationality: {context.get('nationality', 'N/A')}
-Current Location: {context.get('current_location', 'N/A')}
-Language Proficiency: IELTS {context.get('ielts_score', 'N/A')}
-"""
-    
-    def _extract_academic_info(self, context: Dict[str, Any]) -> str:
-        """Extract and format academic information."""
-        return f"""
-Highest Qualification: {context.get('highest_qualification', 'N/A')}
-Institution: {context.get('institution_name', 'N/A')}
-Field of Study: {context.get('field_of_study', 'N/A')}
-Graduation Year: {context.get('graduation_year', 'N/A')}
-Academic Performance: {context.get('gpa_percentage', 'N/A')}%
-"""
+def _compile_sop_template(template: str) -> Tuple[Tuple[bytes, ...], Tuple[str, ...]]:
+    """Split a template into pre-encoded literal parts and slot names.
     
-    def _extract_program_info(self, context: Dict[str, Any]) -> str:
-        """Extract and format program information."""
-        return f"""
-Program: {context.get('program_name', 'N/A')}
-Institution: {context.get('institution_canada', 'N/A')}
-Duration: {context.get('program_duration', 'N/A')}
-Intake: {context.get('intake_term', 'N/A')}
-Tuition Fees: CAD ${context.get('tuition_fees', 0):,.2f}
-"""
+    The returned parts always have one more entry than the slots, so a template
+    renders as ``parts[0] + slot[0] + parts[1] + ... + parts[-1]``.
+    """
+    parts: List[bytes] = []
+    slots: List[str] = []
     
-    def _extract_financial_info(self, context: Dict[str, Any]) -> str:
-        """Extract and format financial information."""
-        return f"""
-Total Funds Available: CAD ${context.get('total_funds_available', 0):,.2f}
-Funding Source: {context.get('funding_source', 'N/A')}
-Sponsor: {context.get('sponsor_relationship', 'Self-funded')}
-"""
+    for literal, field_name, _, _ in Formatter().parse(template):
+        parts.append(literal.encode("utf-8"))
+        if field_name is not None:
+            slots.append(field_name)
     
-    def _extract_career_info(self, context: Dict[str, Any]) -> str:
-        """Extract and format career information."""
-        return f"""
-Work Experience: {context.get('work_experience_years', 0)} years
-Current Position: {context.get('current_job_title', 'Student/Recent Graduate')}
-Career Goals: {context.get('career_goals', 'N/A')}
-Return Plans: {context.get('return_intention', 'N/A')}
-How Program Helps: {context.get('how_program_helps', 'N/A')}
-Home Country Ties: {context.get('ties_to_home_country', 'Strong family connections')}
-"""
+    if len(parts) == len(slots):
+        parts.append(b"")
     
-    def _generate_production_sop(self, context: Dict[str, Any], template_type: str) -> str:
-        """Generate a production-quality SOP."""
-        
-        # Get context values with defaults
-        full_name = context.get('full_name', 'John Doe')
-        age = context.get('age', 25)
-        nationality = context.get('nationality', 'Indian')
-        current_location = context.get('current_location', 'Mumbai, India')
-        highest_qualification = context.get('highest_qualification', "Bachelor's Degree")
-        field_of_study = context.get('field_of_study', 'Computer Science')
-        institution_name = context.get('institution_name', 'University of Mumbai')
-        graduation_year = context.get('graduation_year', 2022)
-        gpa_percentage = context.get('gpa_percentage', 85.0)
-        program_name = context.get('program_name', 'Master of Computer Science')
-        institution_canada = context.get('institution_canada', 'University of Toronto')
-        program_duration = context.get('program_duration', '2 years')
-        intake_term = context.get('intake_term', 'Fall 2024')
-        tuition_fees = context.get('tuition_fees', 45000.0)
-        work_experience_years = context.get('work_experience_years', 2)
-        current_job_title = context.get('current_job_title', 'Software Developer')
-        employer_name = context.get('employer_name', 'Tech Corporation')
-        total_funds_available = context.get('total_funds_available', 75000.0)
-        funding_source = context.get('funding_source', 'family savings and education loan')
-        career_goals = context.get('career_goals', 'To become a data scientist and contribute to AI research')
-        return_intention = context.get('return_intention', 'To return to India and start my own tech company')
-        how_program_helps = context.get('how_program_helps', 'This program will provide advanced knowledge in AI and machine learning')
-        ties_to_home_country = context.get('ties_to_home_country', 'I have strong family ties, property ownership, and career opportunities in my home country')
-        ielts_score = context.get('ielts_score', 7.5)
-        gaps_in_education = context.get('gaps_in_education', '')
-        
-        # Build comprehensive SOP
-        sop = f"""STATEMENT OF PURPOSE
+    return tuple(parts), tuple(slots)
+
+
+# Slots named variant.<name> take a model-written paragraph from
+# _SOP_VARIANT_TEMPLATES; every other slot is filled server-side.
+_VARIANT_SLOT_PREFIX = "variant."
+
+# Applicant-specific paragraphs, the only text requested from the model
+_SOP_VARIANT_TEMPLATES = {
+    "introduction": "I am {full_name}, a {age}-year-old {nationality} citizen currently residing in {current_location}. I am writing to express my sincere intention to pursue {program_name} at {institution_canada}, Canada. This statement outlines my academic background, career aspirations, and compelling reasons for choosing Canada as my study destination, demonstrating my genuine commitment to temporary study and subsequent return to my home country.",
+    "academic_record": "I completed my {highest_qualification} in {field_of_study} from {institution_name} in {graduation_year}, achieving {gpa_percentage}% marks. Throughout my academic journey, I have consistently demonstrated excellence in my studies while developing a robust foundation in {field_of_study}. My undergraduate coursework included advanced subjects such as data structures, algorithms, database management, and software engineering, which have prepared me well for graduate-level studies.",
+    "career_goals": "{career_goals} My short-term goal is to complete my {program_name} with distinction and gain comprehensive knowledge in advanced computing technologies. Upon graduation, I plan to return to {nationality} and apply my Canadian education to contribute to my country's growing technology sector.",
+    "home_ties": "{ties_to_home_country} These strong connections ensure my commitment to returning home after completing my studies.",
+    "return_plan": "{return_intention} I am committed to using my Canadian education to contribute to my country's technological advancement and economic growth. The knowledge and skills I acquire will enable me to create employment opportunities for others and contribute to the development of the technology ecosystem in my home country.",
+}
+
+# SOP body, one template per named section. Constant text is UTF-8 encoded once
+# at import so each request only encodes the small applicant-specific slots.
+_SOP_SECTION_TEMPLATES = (
+    """STATEMENT OF PURPOSE
 
 Dear Visa Officer,
 
-I am {full_name}, a {age}-year-old {nationality} citizen currently residing in {current_location}. I am writing to express my sincere intention to pursue {program_name} at {institution_canada}, Canada. This statement outlines my academic background, career aspirations, and compelling reasons for choosing Canada as my study destination, demonstrating my genuine commitment to temporary study and subsequent return to my home country.
+{variant.introduction}
 
-ACADEMIC BACKGROUND AND ACHIEVEMENTS
+""",
+    """ACADEMIC BACKGROUND AND ACHIEVEMENTS
 
-I completed my {highest_qualification} in {field_of_study} from {institution_name} in {graduation_year}, achieving {gpa_percentage}% marks. Throughout my academic journey, I have consistently demonstrated excellence in my studies while developing a robust foundation in {field_of_study}. My undergraduate coursework included advanced subjects such as data structures, algorithms, database management, and software engineering, which have prepared me well for graduate-level studies.
+{variant.academic_record}
 
 During my academic tenure, I actively participated in various projects and research initiatives. I led a team project on machine learning applications in healthcare, which was recognized as the best project in my final year. Additionally, I completed internships at leading technology companies, where I gained practical experience in software development and data analysis. These experiences have not only enhanced my technical skills but also developed my leadership abilities and collaborative mindset.
 
-{self._add_gap_explanation(gaps_in_education)}
+{gap_explanation}
 
 My academic performance, combined with practical experience, has equipped me with the analytical thinking, problem-solving skills, and technical expertise necessary to excel in the proposed graduate program. I am confident that my strong academic foundation will enable me to contribute meaningfully to the academic community at {institution_canada}.
 
-PROGRAM SELECTION AND INSTITUTIONAL CHOICE
+""",
+    """PROGRAM SELECTION AND INSTITUTIONAL CHOICE
 
 After extensive research and careful consideration, I have chosen {program_name} at {institution_canada} for several compelling reasons. The program's comprehensive curriculum perfectly aligns with my career objectives and offers specialized courses in artificial intelligence, machine learning, and data science – areas where I aim to develop expertise.
 
@@ -185,9 +92,10 @@ The faculty members at {institution_canada} are leading experts in their fields,
 
 Furthermore, Canada's multicultural environment and welcoming attitude toward international students make it an ideal destination for my studies. The country's strong emphasis on innovation and technology aligns perfectly with my career aspirations in the technology sector.
 
-CAREER OBJECTIVES AND FUTURE PLANS
+""",
+    """CAREER OBJECTIVES AND FUTURE PLANS
 
-{career_goals} My short-term goal is to complete my {program_name} with distinction and gain comprehensive knowledge in advanced computing technologies. Upon graduation, I plan to return to {nationality} and apply my Canadian education to contribute to my country's growing technology sector.
+{variant.career_goals}
 
 My long-term career vision includes establishing myself as a leader in the technology industry and eventually starting my own company focused on developing innovative solutions for emerging markets. The advanced knowledge and international exposure I will gain from Canadian education will be instrumental in achieving these goals.
 
@@ -195,31 +103,35 @@ The technology sector in {nationality} is experiencing rapid growth, and there i
 
 {how_program_helps} The program's focus on practical applications and industry-relevant skills will enable me to bridge the gap between academic knowledge and real-world problem-solving, making me a valuable asset to the technology ecosystem in my home country.
 
-FINANCIAL CAPACITY AND PLANNING
+""",
+    """FINANCIAL CAPACITY AND PLANNING
 
-I have made comprehensive financial arrangements to support my studies in Canada. My total available funds amount to CAD ${total_funds_available:,.2f}, which will be sourced from {funding_source}. This amount covers all expenses including tuition fees (CAD ${tuition_fees:,.2f}), living expenses, accommodation, health insurance, and other miscellaneous costs for the entire duration of my program.
+I have made comprehensive financial arrangements to support my studies in Canada. My total available funds amount to CAD ${total_funds_available}, which will be sourced from {funding_source}. This amount covers all expenses including tuition fees (CAD ${tuition_fees}), living expenses, accommodation, health insurance, and other miscellaneous costs for the entire duration of my program.
 
 My family has been planning for my higher education for several years, and we have maintained dedicated savings accounts for this purpose. Additionally, we have secured an education loan from a reputable bank to ensure uninterrupted funding throughout my studies. I have attached all necessary financial documents, including bank statements, income certificates, and loan approval letters, to demonstrate our financial capability.
 
 I understand the financial commitment required for studying in Canada and have carefully budgeted for all expenses. My financial planning ensures that I will not face any financial difficulties during my studies and will not need to seek unauthorized employment.
 
-STRONG TIES TO HOME COUNTRY
+""",
+    """STRONG TIES TO HOME COUNTRY
 
-{ties_to_home_country} These strong connections ensure my commitment to returning home after completing my studies.
+{variant.home_ties}
 
 My parents are approaching retirement age and will require my support and care in their later years. As their only son/daughter, I have a moral and cultural obligation to be present for them. Additionally, my family owns property and business interests that require my involvement and management.
 
 The technology sector in {nationality} offers excellent career opportunities for professionals with international qualifications. Major multinational companies and emerging startups are actively seeking talent with advanced technical skills and global exposure. My Canadian education will make me highly competitive in this job market.
 
-{return_intention} I am committed to using my Canadian education to contribute to my country's technological advancement and economic growth. The knowledge and skills I acquire will enable me to create employment opportunities for others and contribute to the development of the technology ecosystem in my home country.
+{variant.return_plan}
 
-LANGUAGE PROFICIENCY AND CULTURAL ADAPTABILITY
+""",
+    """LANGUAGE PROFICIENCY AND CULTURAL ADAPTABILITY
 
 I have achieved an IELTS score of {ielts_score}, demonstrating my proficiency in English and readiness for academic studies in Canada. My strong communication skills will enable me to participate actively in classroom discussions, collaborate effectively with peers, and engage with faculty members.
 
 Having been exposed to diverse cultures through my work experience and academic projects, I am confident in my ability to adapt to the multicultural environment in Canada. I look forward to learning from students and faculty from different backgrounds and contributing my own perspectives to the academic community.
 
-CONCLUSION
+""",
+    """CONCLUSION
 
 I am fully committed to complying with all visa conditions and Canadian immigration regulations during my stay. I understand that my student visa is temporary and solely for educational purposes. I have no intention of seeking permanent residence or unauthorized employment in Canada.
 
@@ -228,9 +140,366 @@ I respectfully request you to consider my application favorably and grant me the
 I assure you of my genuine intention to study in Canada temporarily and return to {nationality} to apply my knowledge and skills for the betterment of my country. Thank you for your time and consideration.
 
 Sincerely,
-{full_name}"""
+{full_name}""",
+)
+
+_SOP_SECTIONS = tuple(_compile_sop_template(template) for template in _SOP_SECTION_TEMPLATES)
+_SOP_VARIANTS = {name: _compile_sop_template(template) for name, template in _SOP_VARIANT_TEMPLATES.items()}
+_SOP_SLOT_NAMES = frozenset(
+    slot for _, slots in (*_SOP_SECTIONS, *_SOP_VARIANTS.values()) for slot in slots
+    if not slot.startswith(_VARIANT_SLOT_PREFIX)
+)
+
+# Only the variant paragraphs are requested from the model; the boilerplate
+# around them is filled in and spliced back server-side.
+_SOP_VARIANT_SEPARATOR = "---"
+_SOP_VARIANT_SPLIT_RE = re.compile(rf"^[ \t]*{re.escape(_SOP_VARIANT_SEPARATOR)}[ \t]*$", re.MULTILINE)
+_SOP_VARIANT_SKELETON = "\n\n".join(
+    f"{index}. {template}" for index, template in enumerate(_SOP_VARIANT_TEMPLATES.values(), 1)
+)
+
+# Bump whenever the system prompt changes so cached SOP responses are invalidated
+SOP_PROMPT_VERSION = "v1"
+
+# Template-specific guidance, part of the cacheable prompt prefix
+_TEMPLATE_FOCUS = {
+    "standard": "Present a clear, linear narrative from academic background to career goals.",
+    "gap_year": "Address any gap in education candidly and show how the time was used productively.",
+    "career_change": "Explain the motivation for the career change and how prior work experience carries over.",
+}
+
+
+def _build_system_prompt(template_type: str) -> str:
+    """Build the applicant-independent part of the SOP prompt.
+    
+    The text must stay byte-identical for a given template type so that the
+    provider-side prompt cache keeps hitting.
+    """
+    template_focus = _TEMPLATE_FOCUS.get(template_type, _TEMPLATE_FOCUS["standard"])
+    
+    return f"""
+You are an expert immigration consultant specializing in Canada study visa applications. 
+Generate a compelling, authentic, and professional Statement of Purpose (SOP) for a Canada study visa application.
+
+CRITICAL REQUIREMENTS:
+- Word count: {settings.SOP_MIN_WORDS}-{settings.SOP_MAX_WORDS} words
+- Tone: Professional, sincere, and confident
+- Structure: Clear sections with smooth transitions
+- Content: Specific, detailed, and personalized
+- Compliance: Address all visa officer concerns
+
+TEMPLATE FOCUS:
+{template_focus}
+
+OUTPUT FORMAT:
+Write only the {len(_SOP_VARIANT_TEMPLATES)} applicant-specific paragraphs outlined below, in order, separated by a line containing only "{_SOP_VARIANT_SEPARATOR}".
+Headings, greetings and the fixed boilerplate paragraphs are added around them automatically, so do not write them.
+
+{_SOP_VARIANT_SKELETON}
+
+Generate a compelling SOP that will convince visa officers of genuine intent.
+The applicant's details follow.
+"""
+
+
+# Stable prompt prefixes, built once per template type at import
+_SYSTEM_PROMPTS = {template_type: _build_system_prompt(template_type) for template_type in _TEMPLATE_FOCUS}
+
+# Per-applicant prompt suffix; only the field substitution happens per call
+_USER_PROMPT_TEMPLATE = Template("""
+APPLICANT PROFILE:
 
-        return sop
+Name: ${full_name}
+Age: ${age}
+Nationality: ${nationality}
+Current Location: ${current_location}
+Language Proficiency: IELTS ${ielts_score}
+
+
+ACADEMIC BACKGROUND:
+
+Highest Qualification: ${highest_qualification}
+Institution: ${institution_name}
+Field of Study: ${field_of_study}
+Graduation Year: ${graduation_year}
+Academic Performance: ${gpa_percentage}%
+
+
+PROPOSED STUDY:
+
+Program: ${program_name}
+Institution: ${institution_canada}
+Duration: ${program_duration}
+Intake: ${intake_term}
+Tuition Fees: CAD $$${tuition_fees}
+
+
+FINANCIAL CAPACITY:
+
+Total Funds Available: CAD $$${total_funds_available}
+Funding Source: ${funding_source}
+Sponsor: ${sponsor_relationship}
+
+
+CAREER GOALS:
+
+Work Experience: ${work_experience_years} years
+Current Position: ${current_job_title}
+Career Goals: ${career_goals}
+Return Plans: ${return_intention}
+How Program Helps: ${how_program_helps}
+Home Country Ties: ${ties_to_home_country}
+
+""")
+
+# Editing instructions shared by section rewrites and SOP improvements; the
+# applicant profile follows in the user block
+_EDIT_SYSTEM_PROMPT = f"""
+You are an expert immigration consultant editing a Statement of Purpose (SOP) for a Canada study visa application.
+Keep the tone professional, sincere and confident, stay consistent with the applicant profile provided,
+and keep the complete SOP within {settings.SOP_MIN_WORDS}-{settings.SOP_MAX_WORDS} words.
+Return only the rewritten text, without headings or commentary.
+"""
+
+
+class GeminiService:
+    """Google Gemini AI service for SOP generation and content analysis."""
+    
+    def __init__(self):
+        """Initialize Gemini service with API key and configuration."""
+        self.api_key = settings.GEMINI_API_KEY
+        self.model = settings.GEMINI_MODEL
+        self.temperature = settings.GEMINI_TEMPERATURE
+        self.max_tokens = settings.GEMINI_MAX_TOKENS
+        
+        # One pooled HTTP/2 client for every Gemini request, so connections and
+        # TLS sessions are reused instead of re-established per SOP
+        self._client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=30.0
+        )
+    
+    async def aclose(self) -> None:
+        """Close the pooled HTTP client."""
+        await self._client.aclose()
+    
+    async def _generate_content(self, system_prompt: str, user_block: str) -> str:
+        """Call the Gemini generateContent REST endpoint and return the text.
+        
+        The stable system prompt always comes first and the applicant block after
+        it, never interleaved, so the provider's implicit prefix caching can hit.
+        """
+        payload: Dict[str, Any] = {
+            "systemInstruction": {"parts": [{"text": system_prompt}]},
+            "contents": [{"role": "user", "parts": [{"text": user_block}]}],
+            "generationConfig": {
+                "temperature": self.temperature,
+                "maxOutputTokens": self.max_tokens
+            }
+        }
+        
+        for attempt in range(_GEMINI_MAX_RETRIES + 1):
+            response = await self._client.post(
+                _GEMINI_API_URL.format(model=self.model),
+                json=payload,
+                headers={"x-goog-api-key": self.api_key}
+            )
+            if response.status_code not in _GEMINI_RETRY_STATUSES or attempt == _GEMINI_MAX_RETRIES:
+                break
+            
+            # Rate limited or overloaded: back off exponentially before retrying
+            delay = _GEMINI_RETRY_BASE_DELAY * (2 ** attempt)
+            logger.warning(f"Gemini returned {response.status_code}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        
+        response.raise_for_status()
+        
+        candidates = response.json().get("candidates", [])
+        if not candidates:
+            return ""
+        return "".join(part.get("text", "") for part in candidates[0]["content"]["parts"])
+    
+    async def generate_sop(self, context: Dict[str, Any], template_type: str = "standard") -> str:
+        """Generate a comprehensive Statement of Purpose using Gemini."""
+        chunks = [chunk async for chunk in self.stream_sop(context, template_type)]
+        return "".join(chunks)
+    
+    async def stream_sop(self, context: Dict[str, Any], template_type: str = "standard") -> AsyncIterator[str]:
+        """Stream the Statement of Purpose section by section as it is generated."""
+        try:
+            if self.api_key:
+                system_prompt, user_block = self._build_sop_prompt(context, template_type)
+                variants = self._parse_variants(await self._generate_content(system_prompt, user_block))
+            else:
+                # No API key (local development): draft every variant paragraph
+                # from its template instead
+                await asyncio.sleep(0.5)  # Simulate time to first token
+                variants = None
+                
+        except Exception as e:
+            logger.error(f"Gemini SOP generation failed: {str(e)}")
+            variants = None
+        
+        for section in self._splice_sop(context, variants):
+            yield section.decode("utf-8")
+    
+    def _parse_variants(self, text: str) -> Dict[str, bytes]:
+        """Map the model's separator-delimited paragraphs onto the variant slots, in order.
+        
+        Empty or missing paragraphs are left out, so they are drafted instead.
+        """
+        paragraphs = (paragraph.strip() for paragraph in _SOP_VARIANT_SPLIT_RE.split(text))
+        return {
+            name: paragraph.encode("utf-8")
+            for name, paragraph in zip(_SOP_VARIANT_TEMPLATES, paragraphs) if paragraph
+        }
+    
+    def _build_sop_prompt(self, context: Dict[str, Any], template_type: str) -> Tuple[str, str]:
+        """Build the SOP prompt as a stable, cacheable prefix and a per-applicant suffix."""
+        system_prompt = _SYSTEM_PROMPTS.get(template_type, _SYSTEM_PROMPTS["standard"])
+        return system_prompt, _USER_PROMPT_TEMPLATE.substitute(self._prompt_values(context))
+    
+    def _build_edit_prompt(self, context: Dict[str, Any], request: str) -> Tuple[str, str]:
+        """Build an edit prompt as the shared edit instructions and a per-applicant suffix.
+        
+        The applicant profile stays out of the system prompt, so that prefix is
+        identical for every applicant.
+        """
+        return _EDIT_SYSTEM_PROMPT, _USER_PROMPT_TEMPLATE.substitute(self._prompt_values(context)) + request
+    
+    async def rewrite_section(self, context: Dict[str, Any], section_name: str,
+                              section_text: str) -> str:
+        """Rewrite a single SOP section, sending only that section to the model."""
+        if not self.api_key:
+            return f"[Regenerated {section_name} section: enhanced content would be generated here using Gemini AI.]"
+        
+        try:
+            system_prompt, user_block = self._build_edit_prompt(
+                context, f"Rewrite the {section_name} section below to be more compelling and detailed.\n\n{section_text}")
+            return (await self._generate_content(system_prompt, user_block)).strip() or section_text
+            
+        except Exception as e:
+            logger.error(f"Gemini section rewrite failed: {str(e)}")
+            return section_text
+    
+    async def improve_sop(self, context: Dict[str, Any], sop: str, feedback: str) -> str:
+        """Revise a complete SOP according to reviewer feedback."""
+        if not self.api_key:
+            return f"IMPROVED SOP\n\n[Improved SOP based on: {feedback}]"
+        
+        try:
+            system_prompt, user_block = self._build_edit_prompt(
+                context, f"Improve the SOP below based on this feedback, keeping all of its sections:\n{feedback}\n\n{sop}")
+            return (await self._generate_content(system_prompt, user_block)).strip() or sop
+            
+        except Exception as e:
+            logger.error(f"Gemini SOP improvement failed: {str(e)}")
+            return sop
+    
+    def _prompt_values(self, context: Dict[str, Any]) -> Dict[str, Any]:
+        """Resolve the applicant fields referenced by the user prompt template.
+        
+        Control characters are stripped here, since this text goes to the model verbatim.
+        """
+        values = {
+            "full_name": context.get('full_name', 'N/A'),
+            "age": context.get('age', 'N/A'),
+            "nationality": context.get('nationality', 'N/A'),
+            "current_location": context.get('current_location', 'N/A'),
+            "ielts_score": context.get('ielts_score', 'N/A'),
+            "highest_qualification": context.get('highest_qualification', 'N/A'),
+            "institution_name": context.get('institution_name', 'N/A'),
+            "field_of_study": context.get('field_of_study', 'N/A'),
+            "graduation_year": context.get('graduation_year', 'N/A'),
+            "gpa_percentage": context.get('gpa_percentage', 'N/A'),
+            "program_name": context.get('program_name', 'N/A'),
+            "institution_canada": context.get('institution_canada', 'N/A'),
+            "program_duration": context.get('program_duration', 'N/A'),
+            "intake_term": context.get('intake_term', 'N/A'),
+            "tuition_fees": f"{context.get('tuition_fees', 0):,.2f}",
+            "total_funds_available": f"{context.get('total_funds_available', 0):,.2f}",
+            "funding_source": context.get('funding_source', 'N/A'),
+            "sponsor_relationship": context.get('sponsor_relationship', 'Self-funded'),
+            "work_experience_years": context.get('work_experience_years', 0),
+            "current_job_title": context.get('current_job_title', 'Student/Recent Graduate'),
+            "career_goals": context.get('career_goals', 'N/A'),
+            "return_intention": context.get('return_intention', 'N/A'),
+            "how_program_helps": context.get('how_program_helps', 'N/A'),
+            "ties_to_home_country": context.get('ties_to_home_country', 'Strong family connections'),
+        }
+        sanitize = _sanitize
+        return {name: sanitize('', value) if isinstance(value, str) else value for name, value in values.items()}
+    
+    def render_sop_bytes(self, context: Dict[str, Any]) -> bytes:
+        """Render the drafted SOP directly as UTF-8 bytes for HTTP responses.
+        
+        Nothing is sent to the model, so no template type applies; it only
+        shapes the generation prompt.
+        """
+        return b"".join(self._splice_sop(context))
+    
+    def _splice_sop(self, context: Dict[str, Any], variants: Optional[Dict[str, bytes]] = None) -> Iterator[bytes]:
+        """Fill the static sections and splice in the variant paragraphs, one section at a time.
+        
+        Variant paragraphs missing from ``variants`` are drafted from their templates.
+        """
+        slots = self._encode_slots(context)
+        paragraphs = self._draft_variant_paragraphs(slots)
+        if variants:
+            paragraphs.update(variants)
+        for name, paragraph in paragraphs.items():
+            slots[_VARIANT_SLOT_PREFIX + name] = paragraph
+        
+        for parts, names in _SOP_SECTIONS:
+            yield b"".join(part + slots[name] for part, name in zip(parts, names)) + parts[-1]
+    
+    def _encode_slots(self, context: Dict[str, Any]) -> Dict[str, bytes]:
+        """Resolve, sanitize and encode every server-filled slot."""
+        values = self._template_values(context)
+        sanitize = _sanitize
+        return {slot: sanitize('', str(values[slot])).encode("utf-8") for slot in _SOP_SLOT_NAMES}
+    
+    def _draft_variant_paragraphs(self, slots: Dict[str, bytes]) -> Dict[str, bytes]:
+        """Render the applicant-specific paragraphs from their pre-encoded templates."""
+        return {
+            name: b"".join(part + slots[slot] for part, slot in zip(parts, names)) + parts[-1]
+            for name, (parts, names) in _SOP_VARIANTS.items()
+        }
+    
+    def _template_values(self, context: Dict[str, Any]) -> Dict[str, Any]:
+        """Resolve the SOP template slots from the context, applying defaults."""
+        
+        # Get context values with defaults
+        gaps_in_education = context.get('gaps_in_education', '')
+        
+        return {
+            'full_name': context.get('full_name', 'John Doe'),
+            'age': context.get('age', 25),
+            'nationality': context.get('nationality', 'Indian'),
+            'current_location': context.get('current_location', 'Mumbai, India'),
+            'highest_qualification': context.get('highest_qualification', "Bachelor's Degree"),
+            'field_of_study': context.get('field_of_study', 'Computer Science'),
+            'institution_name': context.get('institution_name', 'University of Mumbai'),
+            'graduation_year': context.get('graduation_year', 2022),
+            'gpa_percentage': context.get('gpa_percentage', 85.0),
+            'program_name': context.get('program_name', 'Master of Computer Science'),
+            'institution_canada': context.get('institution_canada', 'University of Toronto'),
+            'program_duration': context.get('program_duration', '2 years'),
+            'intake_term': context.get('intake_term', 'Fall 2024'),
+            'tuition_fees': f"{context.get('tuition_fees', 45000.0):,.2f}",
+            'work_experience_years': context.get('work_experience_years', 2),
+            'current_job_title': context.get('current_job_title', 'Software Developer'),
+            'employer_name': context.get('employer_name', 'Tech Corporation'),
+            'total_funds_available': f"{context.get('total_funds_available', 75000.0):,.2f}",
+            'funding_source': context.get('funding_source', 'family savings and education loan'),
+            'career_goals': context.get('career_goals', 'To become a data scientist and contribute to AI research'),
+            'return_intention': context.get('return_intention', 'To return to India and start my own tech company'),
+            'how_program_helps': context.get('how_program_helps', 'This program will provide advanced knowledge in AI and machine learning'),
+            'ties_to_home_country': context.get('ties_to_home_country', 'I have strong family ties, property ownership, and career opportunities in my home country'),
+            'ielts_score': context.get('ielts_score', 7.5),
+            'gap_explanation': self._add_gap_explanation(gaps_in_education),
+        }
     
     def _add_gap_explanation(self, gaps_in_education: str) -> str:
         """Add explanation for education gaps if present."""
@@ -245,5 +514,13 @@ The gap period has been productive and has contributed to my personal and profes
         return ""
 
 
-# Global Gemini service instance
-gemini_service = GeminiService() 
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_gemini_service() -> GeminiService:
+    """Get the shared Gemini service, created on first use."""
+    return GeminiService()
+
+
+async def close_gemini_service() -> None:
+    """Release the shared Gemini service's connections, if it was ever created."""
+    if get_gemini_service.cache_info().currsize:
+        await get_gemini_service().aclose()
@@ -4,19 +4,184 @@ Generates personalized SOP documents for Canada study visa applications using Ge
 """
 
 import asyncio
-from typing import Dict, Any, Optional, List
-from datetime import datetime
+import copy
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, AsyncIterator, Tuple
+from datetime import datetime, timezone
 import json
 import logging
-from dataclasses import dataclass
+import re
+import time
+from dataclasses import dataclass, asdict
+from functools import lru_cache
 
 from src.core.config import settings
-from src.services.gemini_service import gemini_service
+from src.services.gemini_service import get_gemini_service, SOP_PROMPT_VERSION
 
 logger = logging.getLogger(__name__)
 
+# Text scanning patterns, compiled once at import
+_WORD_RE = re.compile(r"\S+")
+_SENTENCE_END_RE = re.compile(r"[.!?]")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+_SECTION_HEADER_RE = re.compile(r"^[A-Z][A-Z0-9 ,&'/-]*$", re.MULTILINE)
 
-@dataclass
+# Canonical JSON for context hashing; one shared encoder instead of a new one per json.dumps call
+_CANONICAL_JSON = json.JSONEncoder(sort_keys=True, separators=(",", ":"), default=str)
+
+# Section headers counted towards SOP structure
+_SECTION_INDICATORS = (
+    'STATEMENT OF PURPOSE', 'ACADEMIC BACKGROUND', 'PROGRAM',
+    'CAREER', 'FINANCIAL', 'TIES TO HOME', 'CONCLUSION'
+)
+
+# Key content elements checked by the quality validator, with the keywords
+# that evidence each of them
+_KEY_ELEMENTS = (
+    ('personal introduction', ('i am', 'my name is')),
+    ('program mention', ('program', 'course', 'study')),
+    ('career goals', ('career', 'goal', 'objective')),
+    ('financial capacity', ('fund', 'financial', 'money', 'expense')),
+    ('return intention', ('return', 'home country', 'back to'))
+)
+
+# One bit per section indicator, then one per key element
+_SECTION_MASK = (1 << len(_SECTION_INDICATORS)) - 1
+_ELEMENT_BITS = tuple(1 << (len(_SECTION_INDICATORS) + index) for index in range(len(_KEY_ELEMENTS)))
+
+
+def _build_content_scan() -> Tuple[Dict[str, int], "re.Pattern[str]"]:
+    """Build the pattern -> bits table and a single overlapping scan over all patterns.
+    
+    Longer patterns are tried first at each position and also carry the bits
+    of every pattern that is a prefix of them, so no hit is lost when two
+    patterns start at the same offset.
+    """
+    bits: Dict[str, int] = {}
+    for index, indicator in enumerate(_SECTION_INDICATORS):
+        bits[indicator.lower()] = bits.get(indicator.lower(), 0) | 1 << index
+    for element_bit, (_, keywords) in zip(_ELEMENT_BITS, _KEY_ELEMENTS):
+        for keyword in keywords:
+            bits[keyword] = bits.get(keyword, 0) | element_bit
+    
+    patterns = sorted(bits, key=len, reverse=True)
+    for pattern in patterns:
+        for prefix in patterns:
+            if prefix != pattern and pattern.startswith(prefix):
+                bits[pattern] |= bits[prefix]
+    
+    scan = re.compile("(?=(" + "|".join(re.escape(pattern) for pattern in patterns) + "))")
+    return bits, scan
+
+
+_CONTENT_BITS, _CONTENT_RE = _build_content_scan()
+
+
+def _scan_content(content: str) -> int:
+    """Return the bitmask of section indicators and key elements found in the content."""
+    hits = 0
+    for match in _CONTENT_RE.finditer(content.lower()):
+        hits |= _CONTENT_BITS[match.group(1)]
+    return hits
+
+
+def _metrics_from_counts(word_count: int, sentence_count: int, content_hits: int) -> Dict[str, Any]:
+    """Build the SOP metrics dict from word, sentence and content-scan counts."""
+    avg_sentence_length = word_count / max(sentence_count, 1)
+    
+    # Simple readability score (Flesch Reading Ease approximation)
+    readability_score = 206.835 - (1.015 * avg_sentence_length)
+    
+    return {
+        "word_count": word_count,
+        "readability_score": round(readability_score, 2),
+        "sections": bin(content_hits & _SECTION_MASK).count("1"),
+        "content_hits": content_hits,
+        "avg_sentence_length": round(avg_sentence_length, 2)
+    }
+
+
+class _SOPStreamProcessor:
+    """Post-process streamed SOP text line by line, keeping running metrics.
+    
+    Produces the same content and metrics as _post_process followed by
+    _calculate_metrics, but as chunks arrive instead of after the full text.
+    None of the counted patterns can span a line, so per-line counts add up.
+    """
+    
+    def __init__(self):
+        self._pending = ""
+        self._lines: List[str] = []
+        self._received = False
+        self.word_count = 0
+        self.sentence_count = 0
+        self.content_hits = 0
+    
+    def feed(self, chunk: str) -> None:
+        """Consume one streamed chunk; a trailing partial line is held back."""
+        if not chunk:
+            return
+        self._received = True
+        *lines, self._pending = (self._pending + chunk).split('\n')
+        for line in lines:
+            self._add_line(line)
+    
+    def _add_line(self, line: str) -> None:
+        line = line.strip().replace('  ', ' ')
+        if line:
+            self._lines.append(line)
+            self.word_count += len(_WORD_RE.findall(line))
+            self.sentence_count += len(_SENTENCE_END_RE.findall(line))
+            self.content_hits |= _scan_content(line)
+    
+    def finish(self) -> str:
+        """Flush the last line and return the post-processed SOP."""
+        if not self._received:
+            raise ValueError("Generated SOP content is empty")
+        
+        self._add_line(self._pending)
+        self._pending = ""
+        return '\n\n'.join(self._lines)
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Return the metrics of the text processed so far."""
+        if not self._lines:
+            return {"word_count": 0, "readability_score": 0, "sections": 0, "avg_sentence_length": 0}
+        return _metrics_from_counts(self.word_count, self.sentence_count, self.content_hits)
+
+
+def _split_sections(sop: str) -> Dict[str, str]:
+    """Split an SOP into {header: body} on its all-caps header lines.
+    
+    Text before the first header is kept under the empty key.
+    """
+    sections: Dict[str, str] = {}
+    header, start = "", 0
+    for match in _SECTION_HEADER_RE.finditer(sop):
+        body = sop[start:match.start()].strip()
+        if header or body:
+            sections[header] = body
+        header, start = match.group(0), match.end()
+    sections[header] = sop[start:].strip()
+    return sections
+
+
+def _join_sections(sections: Dict[str, str]) -> str:
+    """Reassemble sections produced by _split_sections."""
+    return "\n\n".join(
+        "\n\n".join(part for part in (header, body) if part)
+        for header, body in sections.items()
+    )
+
+
+def _find_section(sections: Dict[str, str], section_name: str) -> Optional[str]:
+    """Return the first header containing section_name, case-insensitively."""
+    name = section_name.upper()
+    return next((header for header in sections if header and name in header), None)
+
+
+@dataclass(frozen=True, slots=True)
 class SOPContext:
     """Context data for SOP generation."""
     # Personal Information
@@ -68,93 +233,173 @@ class SOPContext:
     specialization: Optional[str] = None
 
 
+@lru_cache(maxsize=1024)
+def _context_as_dict(context: SOPContext) -> Dict[str, Any]:
+    """Convert a context to a dictionary, memoized per (hashable, frozen) context.
+    
+    The returned dict is shared between callers and must not be mutated.
+    """
+    return asdict(context)
+
+
+@lru_cache(maxsize=1024)
+def _context_hash(context: SOPContext) -> str:
+    """BLAKE2b over the canonical JSON form of a context, memoized per context."""
+    context_json = _CANONICAL_JSON.encode(_context_as_dict(context))
+    return hashlib.blake2b(context_json.encode(), digest_size=8).hexdigest()
+
+
 class SOPGenerator:
     """AI-powered SOP generator for Canada study visa applications using Gemini."""
     
     def __init__(self):
         self.model_name = settings.DEFAULT_LLM_MODEL
         self.max_retries = 3
-        self.gemini_service = gemini_service
+        self._gemini_service = None
+        
+        # Generated SOPs keyed by context hash, template, model and prompt
+        # version, least recently used first
+        self._response_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        
+        # Bounds concurrent Gemini calls made by batch generation
+        self._semaphore = asyncio.Semaphore(settings.GEMINI_MAX_CONCURRENCY)
+    
+    @property
+    def gemini_service(self):
+        """Get the shared Gemini service, created on first use rather than at import."""
+        if self._gemini_service is None:
+            self._gemini_service = get_gemini_service()
+        return self._gemini_service
     
-    async def generate_sop(self, context: SOPContext, template_type: str = "standard") -> Dict[str, Any]:
-        """Generate a complete SOP document using Gemini AI."""
+    async def generate_sop(self, context: SOPContext, template_type: str = "standard",
+                           bypass_cache: bool = False) -> Dict[str, Any]:
+        """Generate a complete SOP document using Gemini AI.
+        
+        Identical requests within SOP_CACHE_TTL_SECONDS are answered from the
+        response cache unless bypass_cache is set.
+        """
         try:
             # Validate context
-            self._validate_context(context)
+            self.validate_context(context)
+            
+            context_hash = self._generate_context_hash(context)
+            cache_key = self._response_cache_key(context_hash, template_type)
+            
+            if not bypass_cache:
+                cached = self._get_cached_response(cache_key)
+                if cached is not None:
+                    return cached
             
             # Convert context to dictionary for Gemini service
             context_dict = self._context_to_dict(context)
             
-            # Generate SOP content using Gemini
-            sop_content = await self.gemini_service.generate_sop(context_dict, template_type)
-            
-            # Post-process and validate
-            processed_sop = self._post_process(sop_content)
+            # Stream SOP content from Gemini, post-processing and counting
+            # metrics while the rest is still being generated
+            stream = _SOPStreamProcessor()
+            async for chunk in self.gemini_service.stream_sop(context_dict, template_type):
+                stream.feed(chunk)
             
-            # Calculate metrics
-            metrics = self._calculate_metrics(processed_sop)
+            processed_sop = stream.finish()
+            metrics = stream.metrics()
             
             # Validate quality
             quality_check = self._validate_quality(processed_sop, metrics)
             
-            return {
+            result = {
                 "sop_content": processed_sop,
                 "word_count": metrics["word_count"],
                 "readability_score": metrics["readability_score"],
                 "sections": metrics["sections"],
                 "quality_score": quality_check["overall_score"],
                 "quality_feedback": quality_check["feedback"],
-                "generated_at": datetime.utcnow().isoformat(),
+                "generated_at": datetime.fromtimestamp(time.time(), tz=timezone.utc).isoformat(),
                 "template_used": template_type,
-                "context_hash": self._generate_context_hash(context),
+                "context_hash": context_hash,
                 "meets_requirements": quality_check["meets_requirements"]
             }
             
+            self._store_cached_response(cache_key, result)
+            return copy.deepcopy(result)
+            
         except Exception as e:
             logger.error(f"SOP generation failed: {str(e)}")
             raise Exception(f"Failed to generate SOP: {str(e)}")
     
+    async def generate_sops_batch(self, contexts: List[SOPContext],
+                                  template_type: str = "standard") -> List[Any]:
+        """Generate SOPs for many applicants concurrently.
+        
+        At most GEMINI_MAX_CONCURRENCY generations run at once; cached results
+        are returned without taking a slot. Failures are returned in place as
+        exceptions so one bad context does not sink the batch.
+        """
+        tasks = [self._generate_sop_bounded(context, template_type) for context in contexts]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _generate_sop_bounded(self, context: SOPContext, template_type: str) -> Dict[str, Any]:
+        """Generate one SOP under the concurrency limit, checking the cache first."""
+        cache_key = self._response_cache_key(self._generate_context_hash(context), template_type)
+        cached = self._get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+        
+        async with self._semaphore:
+            return await self.generate_sop(context, template_type)
+    
+    def _response_cache_key(self, context_hash: str, template_type: str) -> str:
+        """Build the response cache key for a context hash and template."""
+        return f"{context_hash}:{template_type}:{self.model_name}:{SOP_PROMPT_VERSION}"
+    
+    def _get_cached_response(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """Return a deep copy of a cached SOP result, or None if missing or expired."""
+        cached = self._response_cache.get(cache_key)
+        if not cached:
+            return None
+        
+        expires_at, result = cached
+        if expires_at <= time.time():
+            del self._response_cache[cache_key]
+            return None
+        
+        self._response_cache.move_to_end(cache_key)
+        return copy.deepcopy(result)
+    
+    def _store_cached_response(self, cache_key: str, result: Dict[str, Any]) -> None:
+        """Cache a SOP result, dropping expired entries and then the least recently used."""
+        now = time.time()
+        for key in [key for key, (expires_at, _) in self._response_cache.items() if expires_at <= now]:
+            del self._response_cache[key]
+        
+        self._response_cache[cache_key] = (now + settings.SOP_CACHE_TTL_SECONDS, copy.deepcopy(result))
+        self._response_cache.move_to_end(cache_key)
+        while len(self._response_cache) > settings.SOP_CACHE_MAX_ENTRIES:
+            self._response_cache.popitem(last=False)
+    
+    async def stream_sop(self, context: SOPContext, template_type: str = "standard") -> AsyncIterator[str]:
+        """Stream raw SOP sections from Gemini as they are produced."""
+        self.validate_context(context)
+        context_dict = self._context_to_dict(context)
+        
+        async for chunk in self.gemini_service.stream_sop(context_dict, template_type):
+            yield chunk
+    
+    def render_sop_bytes(self, context: SOPContext) -> bytes:
+        """Render the SOP as UTF-8 bytes, ready to be sent without re-encoding."""
+        self.validate_context(context)
+        context_dict = self._context_to_dict(context)
+        
+        return self.gemini_service.render_sop_bytes(context_dict)
+    
     def _context_to_dict(self, context: SOPContext) -> Dict[str, Any]:
         """Convert SOPContext dataclass to dictionary."""
-        return {
-            'full_name': context.full_name,
-            'age': context.age,
-            'nationality': context.nationality,
-            'current_location': context.current_location,
-            'highest_qualification': context.highest_qualification,
-            'institution_name': context.institution_name,
-            'graduation_year': context.graduation_year,
-            'gpa_percentage': context.gpa_percentage,
-            'field_of_study': context.field_of_study,
-            'program_name': context.program_name,
-            'institution_canada': context.institution_canada,
-            'program_duration': context.program_duration,
-            'intake_term': context.intake_term,
-            'tuition_fees': context.tuition_fees,
-            'work_experience_years': context.work_experience_years,
-            'current_job_title': context.current_job_title,
-            'employer_name': context.employer_name,
-            'relevant_experience': context.relevant_experience,
-            'total_funds_available': context.total_funds_available,
-            'funding_source': context.funding_source,
-            'sponsor_relationship': context.sponsor_relationship,
-            'career_goals': context.career_goals,
-            'return_intention': context.return_intention,
-            'how_program_helps': context.how_program_helps,
-            'ielts_score': context.ielts_score,
-            'english_proficiency': context.english_proficiency,
-            'gaps_in_education': context.gaps_in_education,
-            'previous_visa_refusals': context.previous_visa_refusals,
-            'ties_to_home_country': context.ties_to_home_country,
-            'academic_achievements': context.academic_achievements,
-            'family_income': context.family_income,
-            'marital_status': context.marital_status,
-            'program_level': context.program_level,
-            'specialization': context.specialization
-        }
+        return _context_as_dict(context)
     
-    def _validate_context(self, context: SOPContext) -> None:
-        """Validate that required context fields are present."""
+    def validate_context(self, context: SOPContext) -> None:
+        """Validate that required context fields are present.
+        
+        stream_sop only validates once iteration starts, so streaming routes
+        call this first to fail before the response has begun.
+        """
         required_fields = [
             'full_name', 'nationality', 'program_name', 
             'institution_canada', 'career_goals', 'total_funds_available'
@@ -195,7 +440,7 @@ class SOPGenerator:
         processed_content = '\n\n'.join(processed_lines)
         
         # Ensure proper spacing and formatting
-        processed_content = processed_content.replace('\n\n\n', '\n\n')
+        processed_content = _BLANK_LINES_RE.sub('\n\n', processed_content)
         processed_content = processed_content.replace('  ', ' ')
         
         return processed_content
@@ -205,34 +450,10 @@ class SOPGenerator:
         if not content:
             return {"word_count": 0, "readability_score": 0, "sections": 0, "avg_sentence_length": 0}
         
-        words = content.split()
-        word_count = len(words)
-        
-        # Count sentences
-        sentences = content.count('.') + content.count('!') + content.count('?')
-        avg_sentence_length = word_count / max(sentences, 1)
-        
-        # Simple readability score (Flesch Reading Ease approximation)
-        readability_score = 206.835 - (1.015 * avg_sentence_length)
-        
-        # Count sections (look for section headers)
-        section_indicators = [
-            'STATEMENT OF PURPOSE', 'ACADEMIC BACKGROUND', 'PROGRAM', 
-            'CAREER', 'FINANCIAL', 'TIES TO HOME', 'CONCLUSION'
-        ]
-        
-        sections = 0
-        content_upper = content.upper()
-        for indicator in section_indicators:
-            if indicator in content_upper:
-                sections += 1
-        
-        return {
-            "word_count": word_count,
-            "readability_score": round(readability_score, 2),
-            "sections": sections,
-            "avg_sentence_length": round(avg_sentence_length, 2)
-        }
+        # Section headers and quality keywords are found in the same single scan
+        return _metrics_from_counts(len(_WORD_RE.findall(content)),
+                                    len(_SENTENCE_END_RE.findall(content)),
+                                    _scan_content(content))
     
     def _validate_quality(self, content: str, metrics: Dict[str, Any]) -> Dict[str, Any]:
         """Validate SOP quality against requirements."""
@@ -272,21 +493,15 @@ class SOPGenerator:
             feedback.append("SOP contains all necessary sections")
             score_components.append(95)
         
-        # Content quality checks
-        content_lower = content.lower()
+        # Content quality checks, reusing the scan from _calculate_metrics
+        content_hits = metrics.get("content_hits")
+        if content_hits is None:
+            content_hits = _scan_content(content)
         
         # Check for key elements
-        key_elements = [
-            ('personal introduction', ['i am', 'my name is']),
-            ('program mention', ['program', 'course', 'study']),
-            ('career goals', ['career', 'goal', 'objective']),
-            ('financial capacity', ['fund', 'financial', 'money', 'expense']),
-            ('return intention', ['return', 'home country', 'back to'])
-        ]
-        
         element_score = 0
-        for element_name, keywords in key_elements:
-            if any(keyword in content_lower for keyword in keywords):
+        for element_bit, (element_name, _) in zip(_ELEMENT_BITS, _KEY_ELEMENTS):
+            if content_hits & element_bit:
                 element_score += 20
             else:
                 feedback.append(f"Missing or weak {element_name}")
@@ -310,32 +525,26 @@ class SOPGenerator:
         }
     
     def _generate_context_hash(self, context: SOPContext) -> str:
-        """Generate a hash for the context to track versions."""
-        import hashlib
-        context_str = str(context.__dict__)
-        return hashlib.md5(context_str.encode()).hexdigest()[:16]
+        """Generate a stable hash for the context to track versions and key caches.
+        
+        BLAKE2b over canonical JSON, computed once per distinct context.
+        """
+        return _context_hash(context)
     
     async def regenerate_section(self, original_sop: str, section_name: str, 
                                 context: SOPContext) -> str:
-        """Regenerate a specific section of the SOP."""
+        """Regenerate a specific section of the SOP, leaving the others untouched."""
         try:
-            # Extract the section that needs regeneration
             context_dict = self._context_to_dict(context)
             
-            # Create a focused prompt for section regeneration
-            section_prompt = f"""
-            Regenerate the {section_name} section of this SOP with improved content:
-            
-            Original SOP:
-            {original_sop}
-            
-            Context: {context_dict}
-            
-            Focus on making the {section_name} section more compelling and detailed.
-            """
+            # Only the target section is sent to Gemini; unknown sections are appended
+            sections = _split_sections(original_sop)
+            header = _find_section(sections, section_name) or section_name.upper()
             
-            # For now, return a placeholder - in production, this would call Gemini
-            return f"REGENERATED {section_name.upper()} SECTION\n\n[Enhanced content for {section_name} would be generated here using Gemini AI with the specific context and requirements.]"
+            sections[header] = await self.gemini_service.rewrite_section(
+                context_dict, header, sections.get(header, "")
+            )
+            return _join_sections(sections)
             
         except Exception as e:
             logger.error(f"Section regeneration failed: {str(e)}")
@@ -347,21 +556,7 @@ class SOPGenerator:
         try:
             context_dict = self._context_to_dict(context)
             
-            improvement_prompt = f"""
-            Improve this SOP based on the following feedback:
-            
-            Feedback: {feedback}
-            
-            Original SOP:
-            {original_sop}
-            
-            Context: {context_dict}
-            
-            Provide an improved version that addresses the feedback while maintaining all required elements.
-            """
-            
-            # For now, return a placeholder - in production, this would call Gemini
-            return f"IMPROVED SOP\n\n[Enhanced SOP content addressing the feedback: '{feedback}' would be generated here using Gemini AI.]"
+            return await self.gemini_service.improve_sop(context_dict, original_sop, feedback)
             
         except Exception as e:
             logger.error(f"SOP improvement failed: {str(e)}")
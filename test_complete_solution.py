@@ -4,14 +4,16 @@ Complete Solution Test for VisaMate AI - AWS Integration
 Tests all endpoints and demonstrates the working solution.
 """
 
-import requests
+import asyncio
 import json
 import time
 from datetime import datetime
 
+import httpx
+
 # Configuration
 BASE_URL = "http://localhost:8000"
-API_BASE = f"{BASE_URL}/api/v1"
+API_BASE = "/api/v1"
 
 class VisaMateAPITester:
     """Complete API tester for VisaMate AI."""
@@ -30,24 +32,26 @@ class VisaMateAPITester:
         print(f" {title}")
         print(f"{'='*60}")
     
-    def test_health_endpoints(self):
+    async def test_health_endpoints(self, client):
         """Test health check endpoints."""
         self.print_section("HEALTH CHECK TESTS")
         
         try:
-            # Test basic health
-            response = requests.get(f"{BASE_URL}/health")
-            print(f"✅ Basic Health Check: {response.status_code}")
-            if response.status_code == 200:
-                data = response.json()
+            # Basic and extended health checks are independent
+            basic, extended = await asyncio.gather(
+                client.get("/health"),
+                client.get(f"{API_BASE}/health")
+            )
+            
+            print(f"✅ Basic Health Check: {basic.status_code}")
+            if basic.status_code == 200:
+                data = basic.json()
                 print(f"   Status: {data.get('status', 'unknown')}")
                 print(f"   Timestamp: {data.get('timestamp', 'unknown')}")
             
-            # Test extended health
-            response = requests.get(f"{API_BASE}/health")
-            print(f"✅ Extended Health Check: {response.status_code}")
-            if response.status_code == 200:
-                data = response.json()
+            print(f"✅ Extended Health Check: {extended.status_code}")
+            if extended.status_code == 200:
+                data = extended.json()
                 print(f"   Status: {data.get('status', 'unknown')}")
                 print(f"   Environment: {data.get('environment', 'unknown')}")
                 print(f"   Services: {data.get('services', {})}")
@@ -56,33 +60,35 @@ class VisaMateAPITester:
         except Exception as e:
             print(f"❌ Health Check Error: {str(e)}")
     
-    def test_wizard_endpoints(self):
+    async def test_wizard_endpoints(self, client):
         """Test wizard endpoints."""
         self.print_section("WIZARD FUNCTIONALITY TESTS")
         
         try:
-            # Test wizard tree
-            response = requests.get(f"{API_BASE}/wizard/tree/{self.session_id}")
-            print(f"✅ Wizard Tree: {response.status_code}")
-            if response.status_code == 200:
-                data = response.json()
+            # Wizard tree and wizard start are independent
+            tree, start = await asyncio.gather(
+                client.get(f"{API_BASE}/wizard/tree/{self.session_id}"),
+                client.post(f"{API_BASE}/wizard/start")
+            )
+            
+            print(f"✅ Wizard Tree: {tree.status_code}")
+            if tree.status_code == 200:
+                data = tree.json()
                 print(f"   Session ID: {data.get('session_id', 'unknown')}")
                 print(f"   Total Steps: {data.get('total_steps', 0)}")
                 print(f"   Current Step: {data.get('current_step', 'unknown')}")
                 print(f"   Sections: {len(data.get('sections', []))}")
                 self.results["wizard_tree"] = data
             
-            # Test wizard start
-            response = requests.post(f"{API_BASE}/wizard/start")
-            print(f"✅ Wizard Start: {response.status_code}")
-            if response.status_code == 200:
-                data = response.json()
+            print(f"✅ Wizard Start: {start.status_code}")
+            if start.status_code == 200:
+                data = start.json()
                 print(f"   New Session ID: {data.get('session_id', 'unknown')}")
             
         except Exception as e:
             print(f"❌ Wizard Error: {str(e)}")
     
-    def test_document_endpoints(self):
+    async def test_document_endpoints(self, client):
         """Test document upload endpoints."""
         self.print_section("DOCUMENT UPLOAD TESTS")
         
@@ -112,16 +118,15 @@ class VisaMateAPITester:
                 }
             ]
             
-            for i, doc_data in enumerate(test_documents, 1):
+            # Initialize all document uploads concurrently
+            init_responses = await asyncio.gather(*[
+                client.post(f"{API_BASE}/documents-simple/init", json=doc_data)
+                for doc_data in test_documents
+            ])
+            
+            completions = []
+            for i, (doc_data, response) in enumerate(zip(test_documents, init_responses), 1):
                 print(f"\n--- Document {i}: {doc_data['document_type']} ---")
-                
-                # Initialize document upload
-                response = requests.post(
-                    f"{API_BASE}/documents-simple/init",
-                    json=doc_data,
-                    headers={"Content-Type": "application/json"}
-                )
-                
                 print(f"✅ Document Init ({doc_data['document_type']}): {response.status_code}")
                 
                 if response.status_code == 200:
@@ -139,30 +144,30 @@ class VisaMateAPITester:
                         self.document_ids.append(document_id)
                         self.results["documents"].append(data)
                         
-                        # Test upload completion
-                        complete_data = {
+                        completions.append({
                             "document_id": document_id,
                             "file_size": doc_data["file_size"]
-                        }
-                        
-                        response = requests.post(
-                            f"{API_BASE}/documents-simple/upload-complete",
-                            json=complete_data,
-                            headers={"Content-Type": "application/json"}
-                        )
-                        
-                        print(f"✅ Upload Complete: {response.status_code}")
-                        if response.status_code == 200:
-                            complete_result = response.json()
-                            if complete_result.get('success'):
-                                print(f"   Final Status: {complete_result.get('status')}")
+                        })
                     else:
                         print(f"   Error: {data.get('error', 'Unknown error')}")
                 else:
                     print(f"   HTTP Error: {response.text}")
             
+            # Mark all initialized uploads complete concurrently
+            complete_responses = await asyncio.gather(*[
+                client.post(f"{API_BASE}/documents-simple/upload-complete", json=complete_data)
+                for complete_data in completions
+            ])
+            
+            for complete_data, response in zip(completions, complete_responses):
+                print(f"✅ Upload Complete ({complete_data['document_id']}): {response.status_code}")
+                if response.status_code == 200:
+                    complete_result = response.json()
+                    if complete_result.get('success'):
+                        print(f"   Final Status: {complete_result.get('status')}")
+            
             # Test document listing
-            response = requests.get(f"{API_BASE}/documents-simple/{self.session_id}")
+            response = await client.get(f"{API_BASE}/documents-simple/{self.session_id}")
             print(f"\n✅ Document List: {response.status_code}")
             if response.status_code == 200:
                 data = response.json()
@@ -199,7 +204,7 @@ class VisaMateAPITester:
         except Exception as e:
             print(f"❌ AWS Connectivity Error: {str(e)}")
     
-    def run_all_tests(self):
+    async def run_all_tests(self):
         """Run all tests."""
         print(f"{'='*60}")
         print(" VISAMATE AI - COMPLETE SOLUTION TEST")
@@ -208,10 +213,11 @@ class VisaMateAPITester:
         print(f"Base URL: {BASE_URL}")
         print(f"Session ID: {self.session_id}")
         
-        # Run all test suites
-        self.test_health_endpoints()
-        self.test_wizard_endpoints()
-        self.test_document_endpoints()
+        # Run all test suites over one shared keep-alive connection pool
+        async with httpx.AsyncClient(base_url=BASE_URL, http2=True, timeout=30) as client:
+            await self.test_health_endpoints(client)
+            await self.test_wizard_endpoints(client)
+            await self.test_document_endpoints(client)
         self.test_aws_connectivity()
         
         # Summary
@@ -254,4 +260,4 @@ class VisaMateAPITester:
 
 if __name__ == "__main__":
     tester = VisaMateAPITester()
-    tester.run_all_tests() 
\ No newline at end of file
+    asyncio.run(tester.run_all_tests()) 
\ No newline at end of file
@@ -0,0 +1,30 @@
+"""
+Shared pytest configuration.
+Slow tests are skipped unless --runslow is passed, and integration tests
+unless RUN_INTEGRATION is set in the environment.
+"""
+
+import os
+
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--runslow", action="store_true", default=False, help="run tests marked slow"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    skips = {}
+    if not config.getoption("--runslow"):
+        skips["slow"] = pytest.mark.skip(reason="need --runslow option to run")
+    if not os.getenv("RUN_INTEGRATION"):
+        skips["integration"] = pytest.mark.skip(reason="set RUN_INTEGRATION=1 to run")
+    if not skips:
+        return
+    
+    for item in items:
+        for keyword, skip in skips.items():
+            if item.get_closest_marker(keyword):
+                item.add_marker(skip)
@@ -3,9 +3,14 @@ Unit tests for Form Auto-filling Service.
 Tests the IRCC form generation and auto-filling functionality.
 """
 
+import asyncio
+import copy
+import importlib.util
 import pytest
-from datetime import date, datetime
-from unittest.mock import AsyncMock, patch
+import pytest_asyncio
+from datetime import datetime
+from operator import attrgetter
+from types import MappingProxyType
 
 from src.services.form_service import (
     FormAutoFillService,
@@ -17,63 +22,126 @@ from src.services.form_service import (
 )
 
 
+def _freeze(d):
+    """Recursively wrap a dict and its nested dicts in read-only views."""
+    return MappingProxyType({k: _freeze(v) if isinstance(v, dict) else v for k, v in d.items()})
+
+
+# Sample questionnaire responses, built once and frozen so tests can share them
+_SAMPLE_RESPONSES = _freeze({
+    "basic_info": {
+        "purpose_in_canada": "Study",
+        "duration_of_stay": "Temporarily - more than 6 months",
+        "passport_country_code": "IND",
+        "current_residence": "India",
+        "has_canadian_family": False,
+        "date_of_birth": "2003-05-04"
+    },
+    "education_status": {
+        "has_provincial_attestation": True,
+        "attestation_province": "Ontario",
+        "accepted_to_dli": True,
+        "post_secondary_institution": True,
+        "institution_name": "University of Toronto",
+        "program_name": "Master of Computer Science",
+        "program_duration": "2 years",
+        "program_start_date": "2024-09-01"
+    },
+    "financial_status": {
+        "has_sds_gic": True,
+        "tuition_paid_full": True,
+        "gic_amount": 20635.0,
+        "tuition_amount": 45000.0,
+        "funding_source": "Family savings and GIC"
+    },
+    "language_test": {
+        "has_language_test": True,
+        "test_type": "IELTS",
+        "all_scores_6_plus": True,
+        "listening_score": 7.5,
+        "reading_score": 7.0,
+        "writing_score": 6.5,
+        "speaking_score": 7.0,
+        "overall_score": 7.0
+    },
+    "medical_exam": {
+        "has_medical_exam": True,
+        "exam_date": "2024-01-15",
+        "panel_physician": "Dr. Smith - Authorized Panel Physician",
+        "medical_ref_number": "MED123456789"
+    },
+    "marital_status": "Never Married/Single",
+    "destination_province": "Ontario",
+    "criminal_background": False
+})
+
+
+@pytest.fixture(scope="module")
+def minimal_ircc_form():
+    """One-section, one-field form shared by tests that only read it."""
+    return IRCCForm(
+        form_type=FormType.IMM1294,
+        form_title="Test Form",
+        form_version="1.0",
+        sections=[
+            FormSection(
+                section_id="test_section",
+                section_name="Test Section",
+                fields=[
+                    FormField("test_field", "Test Field", "text", value="test_value")
+                ]
+            )
+        ]
+    )
+
+
+@pytest.fixture(scope="module")
+def make_validation_form():
+    """Factory for a fresh copy of a form with filled and empty fields.
+    
+    _validate_form writes its results onto the form, so every call returns
+    a deep copy of one prebuilt form.
+    """
+    form = IRCCForm(
+        form_type=FormType.IMM1294,
+        form_title="Test Form",
+        form_version="1.0",
+        sections=[
+            FormSection(
+                section_id="test_section",
+                section_name="Test Section",
+                fields=[
+                    FormField("required_filled", "Required Filled", "text", value="test", is_required=True),
+                    FormField("required_empty", "Required Empty", "text", value="", is_required=True),
+                    FormField("optional_empty", "Optional Empty", "text", value="", is_required=False),
+                ]
+            )
+        ]
+    )
+    return lambda: copy.deepcopy(form)
+
+
 class TestFormAutoFillService:
     """Test class for FormAutoFillService."""
     
-    @pytest.fixture
+    @pytest.fixture(scope="module")
     def form_service_instance(self):
-        """Create a form service instance for testing."""
+        """Create a form service instance shared by the module's tests.
+        
+        auto_fill_form works on deep copies of the templates, so tests
+        cannot change the shared instance.
+        """
         return FormAutoFillService()
     
-    @pytest.fixture
-    def sample_questionnaire_responses(self):
-        """Sample questionnaire responses for testing."""
-        return {
-            "basic_info": {
-                "purpose_in_canada": "Study",
-                "duration_of_stay": "Temporarily - more than 6 months",
-                "passport_country_code": "IND",
-                "current_residence": "India",
-                "has_canadian_family": False,
-                "date_of_birth": "2003-05-04"
-            },
-            "education_status": {
-                "has_provincial_attestation": True,
-                "attestation_province": "Ontario",
-                "accepted_to_dli": True,
-                "post_secondary_institution": True,
-                "institution_name": "University of Toronto",
-                "program_name": "Master of Computer Science",
-                "program_duration": "2 years",
-                "program_start_date": "2024-09-01"
-            },
-            "financial_status": {
-                "has_sds_gic": True,
-                "tuition_paid_full": True,
-                "gic_amount": 20635.0,
-                "tuition_amount": 45000.0,
-                "funding_source": "Family savings and GIC"
-            },
-            "language_test": {
-                "has_language_test": True,
-                "test_type": "IELTS",
-                "all_scores_6_plus": True,
-                "listening_score": 7.5,
-                "reading_score": 7.0,
-                "writing_score": 6.5,
-                "speaking_score": 7.0,
-                "overall_score": 7.0
-            },
-            "medical_exam": {
-                "has_medical_exam": True,
-                "exam_date": "2024-01-15",
-                "panel_physician": "Dr. Smith - Authorized Panel Physician",
-                "medical_ref_number": "MED123456789"
-            },
-            "marital_status": "Never Married/Single",
-            "destination_province": "Ontario",
-            "criminal_background": False
-        }
+    @pytest.fixture(scope="session")
+    def sample_responses_ro(self):
+        """Shared read-only sample questionnaire responses."""
+        return _SAMPLE_RESPONSES
+    
+    @pytest_asyncio.fixture(scope="module", loop_scope="module")
+    async def all_generated_forms(self, form_service_instance, sample_responses_ro):
+        """Forms generated once from the sample responses, shared by the auto-fill tests."""
+        return await form_service_instance.generate_all_forms(sample_responses_ro)
     
     def test_form_service_initialization(self, form_service_instance):
         """Test form service initialization."""
@@ -83,141 +151,93 @@ class TestFormAutoFillService:
         assert FormType.IMM5645 in form_service_instance.form_templates
         assert FormType.IMM5257 in form_service_instance.form_templates
     
-    def test_imm1294_template_creation(self, form_service_instance):
-        """Test IMM1294 template creation."""
-        template = form_service_instance.form_templates[FormType.IMM1294]
-        
-        assert template.form_type == FormType.IMM1294
-        assert template.form_title == "Application for Study Permit Made Outside of Canada"
-        assert template.form_version == "11-2023"
-        assert len(template.sections) > 0
-        
-        # Check specific sections exist
-        section_ids = [section.section_id for section in template.sections]
-        expected_sections = [
+    @pytest.mark.parametrize("form_type,title,version,expected_sections", [
+        (FormType.IMM1294, "Application for Study Permit Made Outside of Canada", "11-2023", (
             "personal_details",
-            "passport_travel_doc", 
+            "passport_travel_doc",
             "contact_info",
             "education_occupation",
             "details_study",
             "funds_financial_support",
-            "background_info"
-        ]
-        
-        for expected_section in expected_sections:
-            assert expected_section in section_ids
-    
-    def test_imm5645_template_creation(self, form_service_instance):
-        """Test IMM5645 template creation."""
-        template = form_service_instance.form_templates[FormType.IMM5645]
-        
-        assert template.form_type == FormType.IMM5645
-        assert template.form_title == "Family Information"
-        assert template.form_version == "01-2024"
-        assert len(template.sections) > 0
-        
-        # Check family-related sections
-        section_ids = [section.section_id for section in template.sections]
-        assert "applicant_info" in section_ids
-        assert "family_members" in section_ids
-    
-    def test_imm5257_template_creation(self, form_service_instance):
-        """Test IMM5257 template creation."""
-        template = form_service_instance.form_templates[FormType.IMM5257]
-        
-        assert template.form_type == FormType.IMM5257
-        assert template.form_title == "Application for Temporary Resident Visa Made Outside Canada"
-        assert template.form_version == "03-2014"
+            "background_info",
+        )),
+        (FormType.IMM5645, "Family Information", "01-2024", (
+            "applicant_info",
+            "family_members",
+        )),
+        (FormType.IMM5257, "Application for Temporary Resident Visa Made Outside Canada", "03-2014", (
+            "personal_details",
+            "travel_info",
+        )),
+    ])
+    def test_template_creation(self, form_service_instance, form_type, title, version, expected_sections):
+        """Test each IRCC template's metadata and expected sections."""
+        template = form_service_instance.form_templates[form_type]
+        
+        assert template.form_type == form_type
+        assert template.form_title == title
+        assert template.form_version == version
         assert len(template.sections) > 0
         
-        # Check TRV-specific sections
-        section_ids = [section.section_id for section in template.sections]
-        assert "personal_details" in section_ids
-        assert "travel_info" in section_ids
+        section_ids = frozenset(section.section_id for section in template.sections)
+        assert section_ids.issuperset(expected_sections)
     
     @pytest.mark.asyncio
-    async def test_auto_fill_imm1294(self, form_service_instance, sample_questionnaire_responses):
-        """Test auto-filling IMM1294 form."""
+    async def test_auto_fill_imm1294(self, form_service_instance, sample_responses_ro):
+        """Test auto-filling IMM1294 form through the single-form API."""
         form = await form_service_instance.auto_fill_form(
             FormType.IMM1294, 
-            sample_questionnaire_responses
+            sample_responses_ro
         )
         
         assert form.form_type == FormType.IMM1294
         assert form.completion_percentage > 0
         
         # Check that some fields were auto-filled
-        filled_fields = []
-        for section in form.sections:
-            for field in section.fields:
-                if field.value:
-                    filled_fields.append(field.field_id)
-        
-        # Should have filled some basic fields
-        expected_filled = ["date_of_birth", "country_of_birth", "marital_status"]
-        for field_id in expected_filled:
-            # Check if at least some expected fields are filled
-            pass  # Some fields might not be filled due to mapping logic
+        filled_fields = [f.field_id for f in form.iter_filled_fields()]
         
         assert len(filled_fields) > 0
+        
+        # Should have filled the basic personal details
+        expected_filled = {"date_of_birth", "country_of_birth", "marital_status"}
+        assert expected_filled.issubset(filled_fields)
     
-    @pytest.mark.asyncio
-    async def test_auto_fill_imm5645(self, form_service_instance, sample_questionnaire_responses):
+    def test_auto_fill_imm5645(self, all_generated_forms):
         """Test auto-filling IMM5645 form."""
-        form = await form_service_instance.auto_fill_form(
-            FormType.IMM5645, 
-            sample_questionnaire_responses
-        )
+        form = all_generated_forms[FormType.IMM5645]
         
         assert form.form_type == FormType.IMM5645
         assert form.completion_percentage >= 0
         
         # Check family information fields
-        family_section = next(
-            (s for s in form.sections if s.section_id == "family_members"), 
-            None
-        )
-        assert family_section is not None
+        assert "family_members" in form.sections_by_id
     
-    @pytest.mark.asyncio
-    async def test_auto_fill_imm5257(self, form_service_instance, sample_questionnaire_responses):
+    def test_auto_fill_imm5257(self, all_generated_forms):
         """Test auto-filling IMM5257 form."""
-        form = await form_service_instance.auto_fill_form(
-            FormType.IMM5257, 
-            sample_questionnaire_responses
-        )
+        form = all_generated_forms[FormType.IMM5257]
         
         assert form.form_type == FormType.IMM5257
         assert form.completion_percentage >= 0
         
         # Check travel information
-        travel_section = next(
-            (s for s in form.sections if s.section_id == "travel_info"), 
-            None
-        )
-        assert travel_section is not None
+        assert "travel_info" in form.sections_by_id
         
         # Check purpose of visit is set to Study
-        purpose_field = None
-        for field in travel_section.fields:
-            if field.field_id == "purpose_of_visit":
-                purpose_field = field
-                break
+        purpose_field = form.sections_by_id["travel_info"].fields_by_id.get("purpose_of_visit")
         
         if purpose_field and purpose_field.value:
             assert purpose_field.value == "Study"
     
-    @pytest.mark.asyncio
-    async def test_generate_all_forms(self, form_service_instance, sample_questionnaire_responses):
+    def test_generate_all_forms(self, form_service_instance, sample_responses_ro, all_generated_forms):
         """Test generating all required forms."""
-        forms = await form_service_instance.generate_all_forms(sample_questionnaire_responses)
+        forms = all_generated_forms
         
         assert isinstance(forms, dict)
         assert FormType.IMM1294 in forms
         assert FormType.IMM5645 in forms
         
         # Check if TRV is generated for Indian passport
-        if form_service_instance._needs_trv(sample_questionnaire_responses):
+        if form_service_instance._needs_trv(sample_responses_ro):
             assert FormType.IMM5257 in forms
         
         # Verify all forms are properly filled
@@ -226,68 +246,33 @@ class TestFormAutoFillService:
             assert form.form_type == form_type
             assert form.completion_percentage >= 0
     
-    def test_needs_trv_logic(self, form_service_instance, sample_questionnaire_responses):
+    @pytest.mark.parametrize("country,expected", [
+        ("IND", True),   # Indian passport should require TRV
+        ("CAN", False),  # Canadian passport should not need TRV
+        ("USA", False),  # US passport should not need TRV
+    ])
+    def test_needs_trv_logic(self, form_service_instance, country, expected):
         """Test TRV requirement logic."""
-        # Indian passport should require TRV
-        assert form_service_instance._needs_trv(sample_questionnaire_responses) == True
-        
-        # Test with Canadian passport (should not need TRV)
-        canadian_responses = sample_questionnaire_responses.copy()
-        canadian_responses["basic_info"]["passport_country_code"] = "CAN"
-        assert form_service_instance._needs_trv(canadian_responses) == False
-        
-        # Test with US passport (should not need TRV)
-        us_responses = sample_questionnaire_responses.copy()
-        us_responses["basic_info"]["passport_country_code"] = "USA"
-        assert form_service_instance._needs_trv(us_responses) == False
+        responses = {"basic_info": {"passport_country_code": country}}
+        assert form_service_instance._needs_trv(responses) is expected
     
-    def test_form_validation(self, form_service_instance):
+    def test_form_validation(self, form_service_instance, make_validation_form):
         """Test form validation logic."""
-        # Create a test form with some filled and unfilled required fields
-        form = IRCCForm(
-            form_type=FormType.IMM1294,
-            form_title="Test Form",
-            form_version="1.0",
-            sections=[
-                FormSection(
-                    section_id="test_section",
-                    section_name="Test Section",
-                    fields=[
-                        FormField("required_filled", "Required Filled", "text", value="test", is_required=True),
-                        FormField("required_empty", "Required Empty", "text", value="", is_required=True),
-                        FormField("optional_empty", "Optional Empty", "text", value="", is_required=False),
-                    ]
-                )
-            ]
-        )
+        # A form with some filled and unfilled required fields
+        form = make_validation_form()
         
         validated_form = form_service_instance._validate_form(form)
         
-        # Should have 33.33% completion (1 out of 3 fields filled)
-        assert validated_form.completion_percentage == pytest.approx(33.33, rel=1e-2)
+        # Should have 33.33% completion (1 out of 3 fields filled), computed
+        # the same way as _validate_form so the float matches exactly
+        assert validated_form.completion_percentage == 1 / 3 * 100
         assert not validated_form.is_valid  # Should be invalid due to empty required field
         assert len(validated_form.validation_errors) == 1
         assert "Required Empty" in validated_form.validation_errors[0]
     
-    def test_export_form_to_pdf_data(self, form_service_instance):
+    def test_export_form_to_pdf_data(self, form_service_instance, minimal_ircc_form):
         """Test exporting form to PDF data format."""
-        # Create a simple test form
-        form = IRCCForm(
-            form_type=FormType.IMM1294,
-            form_title="Test Form",
-            form_version="1.0",
-            sections=[
-                FormSection(
-                    section_id="test_section",
-                    section_name="Test Section",
-                    fields=[
-                        FormField("test_field", "Test Field", "text", value="test_value")
-                    ]
-                )
-            ]
-        )
-        
-        pdf_data = form_service_instance.export_form_to_pdf_data(form)
+        pdf_data = form_service_instance.export_form_to_pdf_data(minimal_ircc_form)
         
         assert pdf_data["form_type"] == "IMM1294"
         assert pdf_data["form_title"] == "Test Form"
@@ -323,81 +308,79 @@ class TestFormAutoFillService:
         """Test that form fields have appropriate types."""
         imm1294 = form_service_instance.form_templates[FormType.IMM1294]
         
-        # Check for various field types
-        field_types = set()
-        for section in imm1294.sections:
-            for field in section.fields:
-                field_types.add(field.field_type)
-        
         expected_types = {"text", "date", "select", "textarea", "number", "radio", "email"}
-        assert field_types.intersection(expected_types)  # Should have some of these types
+        assert imm1294.field_types & expected_types  # Should have some of these types
     
     def test_global_form_service_instance(self):
         """Test that global form service instance is available."""
-        from src.services.form_service import form_service as global_service
-        
-        assert global_service is not None
-        assert isinstance(global_service, FormAutoFillService)
-        assert len(global_service.form_templates) == 3
+        assert form_service is not None
+        assert isinstance(form_service, FormAutoFillService)
+        assert len(form_service.form_templates) == 3
 
 
 class TestFormDataStructures:
     """Test form data structure classes."""
     
-    def test_form_field_creation(self):
-        """Test FormField creation."""
-        field = FormField(
-            field_id="test_id",
-            field_name="Test Field",
-            field_type="text",
-            value="test_value",
-            is_required=True,
-            help_text="Test help text"
-        )
-        
-        assert field.field_id == "test_id"
-        assert field.field_name == "Test Field"
-        assert field.field_type == "text"
-        assert field.value == "test_value"
-        assert field.is_required == True
-        assert field.help_text == "Test help text"
+    @pytest.mark.parametrize("cls,kwargs,checks", [
+        (FormField, {
+            "field_id": "test_id",
+            "field_name": "Test Field",
+            "field_type": "text",
+            "value": "test_value",
+            "is_required": True,
+            "help_text": "Test help text"
+        }, [
+            ("field_id", "test_id"),
+            ("field_name", "Test Field"),
+            ("field_type", "text"),
+            ("value", "test_value"),
+            ("is_required", True),
+            ("help_text", "Test help text"),
+        ]),
+        (FormSection, {
+            "section_id": "test_section",
+            "section_name": "Test Section",
+            "fields": [FormField("field1", "Field 1", "text"), FormField("field2", "Field 2", "date")],
+            "instructions": "Test instructions"
+        }, [
+            ("section_id", "test_section"),
+            ("section_name", "Test Section"),
+            ("fields", [FormField("field1", "Field 1", "text"), FormField("field2", "Field 2", "date")]),
+            ("instructions", "Test instructions"),
+        ]),
+        (IRCCForm, {
+            "form_type": FormType.IMM1294,
+            "form_title": "Test Form",
+            "form_version": "1.0"
+        }, [
+            ("form_type", FormType.IMM1294),
+            ("form_title", "Test Form"),
+            ("form_version", "1.0"),
+            ("completion_percentage", 0.0),
+            ("is_valid", False),
+            ("validation_errors", []),
+            ("generated_at.__class__", datetime),
+        ]),
+    ])
+    def test_creation(self, cls, kwargs, checks):
+        """Test FormField, FormSection and IRCCForm creation."""
+        obj = cls(**kwargs)
+        for name, expected in checks:
+            assert attrgetter(name)(obj) == expected
     
-    def test_form_section_creation(self):
-        """Test FormSection creation."""
+    def test_form_section_fields_by_id(self):
+        """Test FormSection's field index."""
         fields = [
             FormField("field1", "Field 1", "text"),
             FormField("field2", "Field 2", "date")
         ]
+        section = FormSection(section_id="test_section", section_name="Test Section", fields=fields)
         
-        section = FormSection(
-            section_id="test_section",
-            section_name="Test Section",
-            fields=fields,
-            instructions="Test instructions"
-        )
-        
-        assert section.section_id == "test_section"
-        assert section.section_name == "Test Section"
-        assert len(section.fields) == 2
-        assert section.instructions == "Test instructions"
-    
-    def test_ircc_form_creation(self):
-        """Test IRCCForm creation."""
-        form = IRCCForm(
-            form_type=FormType.IMM1294,
-            form_title="Test Form",
-            form_version="1.0"
-        )
-        
-        assert form.form_type == FormType.IMM1294
-        assert form.form_title == "Test Form"
-        assert form.form_version == "1.0"
-        assert form.completion_percentage == 0.0
-        assert form.is_valid == False
-        assert len(form.validation_errors) == 0
-        assert isinstance(form.generated_at, datetime)
+        assert section.fields_by_id["field2"] is fields[1]
+        assert section.fields_by_id.get("missing") is None
 
 
+@pytest.mark.slow
 @pytest.mark.integration
 class TestFormServiceIntegration:
     """Integration tests for form service with other components."""
@@ -409,11 +392,13 @@ class TestFormServiceIntegration:
         # from the wizard API
         pass
     
-    @pytest.mark.asyncio
-    async def test_form_generation_performance(self):
-        """Test form generation performance."""
-        import time
-        
+    @pytest.mark.skipif(
+        importlib.util.find_spec("pytest_benchmark") is None,
+        reason="pytest-benchmark not installed"
+    )
+    @pytest.mark.benchmark(group="form_gen")
+    def test_form_generation_performance(self, benchmark):
+        """Benchmark generating all forms for a minimal questionnaire."""
         sample_responses = {
             "basic_info": {"passport_country_code": "IND", "date_of_birth": "2003-05-04"},
             "education_status": {"institution_name": "Test University"},
@@ -422,12 +407,12 @@ class TestFormServiceIntegration:
             "medical_exam": {"has_medical_exam": True}
         }
         
-        start_time = time.time()
-        forms = await form_service.generate_all_forms(sample_responses)
-        end_time = time.time()
+        forms = benchmark.pedantic(
+            lambda: asyncio.run(form_service.generate_all_forms(sample_responses)),
+            rounds=5,
+            iterations=1
+        )
         
-        # Should generate forms quickly (under 1 second)
-        assert end_time - start_time < 1.0
         assert len(forms) >= 2  # At least IMM1294 and IMM5645
 
 
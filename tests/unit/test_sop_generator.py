@@ -5,15 +5,23 @@ Tests the AI-powered SOP generation functionality.
 
 import pytest
 import asyncio
-from unittest.mock import Mock, patch
-from datetime import datetime
+from unittest.mock import AsyncMock, Mock, patch
+from dataclasses import FrozenInstanceError, replace
+from datetime import datetime, timezone
+from types import SimpleNamespace
 
+from src.core.config import settings
+from src.services import gemini_service
 from src.services.sop_service import SOPGenerator, SOPContext, sop_generator
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def sample_context():
-    """Sample SOP context for testing."""
+    """Sample SOP context for testing.
+    
+    SOPContext is frozen, so one instance is shared by the module and tests
+    derive variants with dataclasses.replace.
+    """
     return SOPContext(
         full_name="John Doe",
         age=25,
@@ -40,6 +48,16 @@ def sample_context():
     )
 
 
+@pytest.fixture(autouse=True)
+def _fast_llm(monkeypatch):
+    """Skip the simulated time-to-first-token delay.
+    
+    Only gemini_service's own asyncio name is replaced, so the event loop and
+    every other module keep the real asyncio.sleep.
+    """
+    monkeypatch.setattr(gemini_service, "asyncio", SimpleNamespace(sleep=AsyncMock()))
+
+
 @pytest.fixture
 def sop_gen():
     """SOP generator instance for testing."""
@@ -70,60 +88,194 @@ class TestSOPGenerator:
     @pytest.mark.asyncio
     async def test_generate_sop_with_gaps(self, sop_gen, sample_context):
         """Test SOP generation with education gaps."""
-        sample_context.gaps_in_education = "Took a gap year to work and gain experience"
+        sample_context = replace(sample_context, gaps_in_education="Took a gap year to work and gain experience")
         
-        result = await sop_gen.generate_sop(sample_context)
+        result = await sop_gen.generate_sop(sample_context, "gap_year")
         
         assert result["template_used"] == "gap_year"
-        assert "sop_content" in result
+        assert "EXPLANATION OF EDUCATION GAP" in result["sop_content"]
+        assert sample_context.gaps_in_education in result["sop_content"]
     
     @pytest.mark.asyncio
     async def test_generate_sop_career_change(self, sop_gen, sample_context):
         """Test SOP generation for career change scenario."""
-        sample_context.work_experience_years = 5
-        sample_context.gaps_in_education = None
+        sample_context = replace(sample_context, work_experience_years=5, gaps_in_education=None)
         
-        result = await sop_gen.generate_sop(sample_context)
+        result = await sop_gen.generate_sop(sample_context, "career_change")
         
         assert result["template_used"] == "career_change"
+        assert "EXPLANATION OF EDUCATION GAP" not in result["sop_content"]
+    
+    @pytest.mark.asyncio
+    async def test_generate_sop_uses_response_cache(self, sop_gen, sample_context, monkeypatch):
+        """Test that repeat requests are served from the response cache."""
+        calls = []
+        original = sop_gen.gemini_service.stream_sop
+        
+        async def counting_stream_sop(context_dict, template_type="standard"):
+            calls.append(template_type)
+            async for chunk in original(context_dict, template_type):
+                yield chunk
+        
+        monkeypatch.setattr(sop_gen.gemini_service, "stream_sop", counting_stream_sop)
+        
+        first = await sop_gen.generate_sop(sample_context)
+        first["quality_feedback"].append("caller edit")
+        second = await sop_gen.generate_sop(sample_context)
+        assert "caller edit" not in second["quality_feedback"]
+        assert len(calls) == 1
+        
+        await sop_gen.generate_sop(sample_context, bypass_cache=True)
+        assert len(calls) == 2
+    
+    def test_response_cache_is_bounded(self, sop_gen, monkeypatch):
+        """Test that the response cache evicts expired, then least recently used, entries."""
+        monkeypatch.setattr(settings, "SOP_CACHE_MAX_ENTRIES", 2)
+        sop_gen._response_cache["expired"] = (0.0, {})
+        
+        for key in ("a", "b", "c"):
+            sop_gen._store_cached_response(key, {"key": key})
+        
+        assert list(sop_gen._response_cache) == ["b", "c"]
+        assert sop_gen._get_cached_response("b") == {"key": "b"}
+    
+    @pytest.mark.asyncio
+    async def test_generate_sops_batch(self, sop_gen, sample_context):
+        """Test concurrent batch generation returns results and errors in order."""
+        invalid_context = replace(sample_context, full_name="")
+        
+        results = await sop_gen.generate_sops_batch([sample_context, invalid_context])
+        
+        assert len(results) == 2
+        assert sample_context.full_name in results[0]["sop_content"]
+        assert isinstance(results[1], Exception)
+    
+    @pytest.mark.asyncio
+    async def test_stream_sop_yields_sections(self, sop_gen, sample_context):
+        """Test that the SOP is streamed section by section."""
+        chunks = [chunk async for chunk in sop_gen.stream_sop(sample_context)]
+        
+        assert len(chunks) > 1
+        assert chunks[0].startswith("STATEMENT OF PURPOSE")
+        assert chunks[-1].startswith("CONCLUSION")
+        assert sample_context.full_name in "".join(chunks)
+    
+    @pytest.mark.asyncio
+    async def test_stream_sop_uses_model_paragraphs(self, sop_gen, sample_context, monkeypatch):
+        """Test that with an API key the model's paragraphs replace the drafted ones."""
+        generate = AsyncMock(return_value="Model introduction.\n---\nModel academic record.")
+        monkeypatch.setattr(sop_gen.gemini_service, "api_key", "test-key")
+        monkeypatch.setattr(sop_gen.gemini_service, "_generate_content", generate)
+        
+        sop = "".join([chunk async for chunk in sop_gen.stream_sop(sample_context)])
+        
+        generate.assert_awaited_once()
+        assert "Model introduction." in sop
+        assert "Model academic record." in sop
+        # Paragraphs the model did not return are drafted from their templates
+        assert sample_context.career_goals in sop
+    
+    @pytest.mark.asyncio
+    async def test_render_sop_bytes_matches_stream(self, sop_gen, sample_context):
+        """Test that the pre-encoded renderer matches the streamed text."""
+        chunks = [chunk async for chunk in sop_gen.stream_sop(sample_context)]
+        
+        rendered = sop_gen.render_sop_bytes(sample_context)
+        
+        assert isinstance(rendered, bytes)
+        assert rendered.decode("utf-8") == "".join(chunks)
+    
+    @pytest.mark.asyncio
+    async def test_generate_sop_streamed_metrics_match_full_pass(self, sop_gen, sample_context):
+        """Test that metrics gathered while streaming match a pass over the full text."""
+        raw = "".join([chunk async for chunk in sop_gen.stream_sop(sample_context)])
+        expected_content = sop_gen._post_process(raw)
+        expected_metrics = sop_gen._calculate_metrics(expected_content)
+        
+        result = await sop_gen.generate_sop(sample_context, bypass_cache=True)
+        
+        assert result["sop_content"] == expected_content
+        assert result["word_count"] == expected_metrics["word_count"]
+        assert result["readability_score"] == expected_metrics["readability_score"]
+        assert result["sections"] == expected_metrics["sections"]
+    
+    def test_render_sop_strips_control_characters(self, sop_gen, sample_context):
+        """Test that control characters in applicant text never reach the SOP."""
+        sample_context = replace(sample_context, career_goals="Build\x00 safe\x1b systems")
+        
+        rendered = sop_gen.render_sop_bytes(sample_context)
+        
+        assert b"Build safe systems" in rendered
+        assert b"\x00" not in rendered and b"\x1b" not in rendered
+    
+    def test_sop_prompt_strips_control_characters(self, sop_gen, sample_context):
+        """Test that control characters in applicant text never reach the model prompt."""
+        context_dict = sop_gen._context_to_dict(replace(sample_context, career_goals="Build\x00 safe\x1b systems"))
+        
+        _, user_block = sop_gen.gemini_service._build_sop_prompt(context_dict, "standard")
+        
+        assert "Build safe systems" in user_block
+        assert "\x00" not in user_block and "\x1b" not in user_block
+    
+    def test_sop_prompt_prefix_is_stable(self, sop_gen, sample_context):
+        """Test that only the applicant block varies between prompts."""
+        context_dict = sop_gen._context_to_dict(sample_context)
+        other_dict = dict(context_dict, full_name="Jane Doe")
+        
+        prefix, user_block = sop_gen.gemini_service._build_sop_prompt(context_dict, "standard")
+        other_prefix, other_block = sop_gen.gemini_service._build_sop_prompt(other_dict, "standard")
+        
+        assert prefix == other_prefix
+        assert sample_context.full_name not in prefix
+        assert sample_context.full_name in user_block
+        assert "Jane Doe" in other_block
+    
+    def test_sop_prompt_requests_only_variant_paragraphs(self, sop_gen, sample_context):
+        """Test that boilerplate stays out of the prompt and model paragraphs are spliced in."""
+        context_dict = sop_gen._context_to_dict(sample_context)
+        prefix, _ = sop_gen.gemini_service._build_sop_prompt(context_dict, "standard")
+        
+        assert "faculty members at" not in prefix
+        assert "Sincerely" not in prefix
+        
+        rendered = b"".join(sop_gen.gemini_service._splice_sop(context_dict, {"home_ties": b"Model-written ties."}))
+        assert b"Model-written ties." in rendered
+        assert f"faculty members at {sample_context.institution_canada}".encode() in rendered
     
     def test_validate_context_success(self, sop_gen, sample_context):
         """Test successful context validation."""
         # Should not raise any exception
-        sop_gen._validate_context(sample_context)
+        sop_gen.validate_context(sample_context)
     
     def test_validate_context_missing_required_field(self, sop_gen, sample_context):
         """Test context validation with missing required field."""
-        sample_context.full_name = ""
+        sample_context = replace(sample_context, full_name="")
         
         with pytest.raises(ValueError, match="Required field 'full_name' is missing"):
-            sop_gen._validate_context(sample_context)
+            sop_gen.validate_context(sample_context)
     
-    def test_select_template_standard(self, sop_gen, sample_context):
-        """Test template selection for standard case."""
-        template = sop_gen._select_template(sample_context, "standard")
-        
-        assert "Write a compelling Statement of Purpose" in template
-        assert "INTRODUCTION" in template
-        assert "ACADEMIC BACKGROUND" in template
+    @pytest.mark.parametrize("template_type,gaps_in_education,prompt_fragment,has_gap_section", [
+        ("standard", None, "Present a clear, linear narrative", False),
+        ("gap_year", "Gap year explanation", "Address any gap in education candidly", True),
+    ], ids=["standard", "gap_year"])
+    def test_select_template(self, sop_gen, sample_context, template_type, gaps_in_education,
+                             prompt_fragment, has_gap_section):
+        """Test template selection for the standard and gap year cases."""
+        context = replace(sample_context, gaps_in_education=gaps_in_education)
+        
+        system_prompt, _ = sop_gen.gemini_service._build_sop_prompt(sop_gen._context_to_dict(context), template_type)
+        sop = sop_gen.render_sop_bytes(context).decode("utf-8")
+        
+        assert prompt_fragment in system_prompt
+        assert ("EXPLANATION OF EDUCATION GAP" in sop) is has_gap_section
     
-    def test_select_template_gap_year(self, sop_gen, sample_context):
-        """Test template selection for gap year case."""
-        sample_context.gaps_in_education = "Gap year explanation"
-        
-        template = sop_gen._select_template(sample_context, "standard")
+    def test_context_to_prompt(self, sop_gen, sample_context):
+        """Test context serialization into the applicant block of the prompt."""
+        _, user_block = sop_gen.gemini_service._build_sop_prompt(sop_gen._context_to_dict(sample_context), "standard")
         
-        assert "EXPLANATION OF GAPS" in template
-    
-    def test_context_to_string(self, sop_gen, sample_context):
-        """Test context serialization to string."""
-        context_str = sop_gen._context_to_string(sample_context)
-        
-        assert sample_context.full_name in context_str
-        assert sample_context.program_name in context_str
-        assert str(sample_context.tuition_fees) in context_str
-        assert "Personal Information:" in context_str
-        assert "Education:" in context_str
+        assert sample_context.full_name in user_block
+        assert sample_context.program_name in user_block
+        assert f"{sample_context.tuition_fees:,.2f}" in user_block
     
     def test_calculate_metrics(self, sop_gen):
         """Test SOP metrics calculation."""
@@ -142,7 +294,22 @@ class TestSOPGenerator:
         
         assert metrics["word_count"] > 0
         assert isinstance(metrics["readability_score"], float)
-    
+
+    def test_validate_quality_key_elements(self, sop_gen):
+        """Test that section headers and key elements come from the shared content scan."""
+        content = "PROGRAM\nCAREER\nMy name is Jo. I will return home after the course. My goal is clear."
+
+        metrics = sop_gen._calculate_metrics(content)
+        quality = sop_gen._validate_quality(content, metrics)
+
+        assert metrics["sections"] == 2
+        assert "Missing or weak financial capacity" in quality["feedback"]
+        assert not any(
+            item.startswith("Missing or weak") and "financial" not in item
+            for item in quality["feedback"]
+        )
+        assert quality["score_breakdown"]["content_score"] == 80
+
     def test_post_process(self, sop_gen):
         """Test SOP content post-processing."""
         raw_content = """
@@ -177,8 +344,7 @@ class TestSOPGenerator:
         assert len(hash1) == 16
         
         # Different context should produce different hash
-        sample_context.full_name = "Jane Doe"
-        hash3 = sop_gen._generate_context_hash(sample_context)
+        hash3 = sop_gen._generate_context_hash(replace(sample_context, full_name="Jane Doe"))
         assert hash1 != hash3
     
     @pytest.mark.asyncio
@@ -191,6 +357,36 @@ class TestSOPGenerator:
         
         assert "Regenerated ACADEMIC BACKGROUND section" in result
     
+    @pytest.mark.asyncio
+    async def test_regenerate_section_only_replaces_target(self, sop_gen, sample_context):
+        """Test that regenerating one section keeps every other section intact."""
+        original_sop = (await sop_gen.generate_sop(sample_context))["sop_content"]
+        
+        result = await sop_gen.regenerate_section(original_sop, "career", sample_context)
+        
+        head, _, tail = original_sop.partition("CAREER OBJECTIVES AND FUTURE PLANS")
+        new_head, _, new_tail = result.partition("CAREER OBJECTIVES AND FUTURE PLANS")
+        assert new_head == head
+        assert "Regenerated CAREER OBJECTIVES AND FUTURE PLANS section" in new_tail
+        assert new_tail.endswith(tail[tail.index("FINANCIAL CAPACITY AND PLANNING"):])
+    
+    @pytest.mark.asyncio
+    async def test_rewrite_section_sends_edit_prompt(self, sop_gen, sample_context, monkeypatch):
+        """Test that edits keep the applicant out of the system prompt and fall back on failure."""
+        service = sop_gen.gemini_service
+        context_dict = sop_gen._context_to_dict(sample_context)
+        generate = AsyncMock(return_value=" Rewritten text. ")
+        monkeypatch.setattr(service, "api_key", "test-key")
+        monkeypatch.setattr(service, "_generate_content", generate)
+        
+        assert await service.rewrite_section(context_dict, "CONCLUSION", "Old text.") == "Rewritten text."
+        system_prompt, user_block = generate.await_args.args
+        assert sample_context.full_name not in system_prompt
+        assert sample_context.full_name in user_block and "Old text." in user_block
+        
+        generate.side_effect = RuntimeError("Gemini unavailable")
+        assert await service.rewrite_section(context_dict, "CONCLUSION", "Old text.") == "Old text."
+    
     @pytest.mark.asyncio
     async def test_improve_sop(self, sop_gen, sample_context):
         """Test SOP improvement functionality."""
@@ -243,6 +439,14 @@ class TestSOPContext:
         assert context.ielts_score is None
         assert context.gaps_in_education is None
         assert context.previous_visa_refusals is False
+    
+    def test_sop_context_is_frozen_and_hashable(self, sample_context):
+        """Test that contexts are immutable and can key caches."""
+        with pytest.raises(FrozenInstanceError):
+            sample_context.full_name = "Jane Doe"
+        
+        assert hash(sample_context) == hash(replace(sample_context))
+        assert not hasattr(sample_context, "__dict__")
 
 
 class TestGlobalSOPGenerator:
@@ -280,5 +484,5 @@ class TestSOPGeneratorIntegration:
         
         # Verify timestamp is recent
         generated_time = datetime.fromisoformat(result["generated_at"])
-        time_diff = datetime.utcnow() - generated_time
+        time_diff = datetime.now(timezone.utc) - generated_time
         assert time_diff.total_seconds() < 60  # Generated within last minute 
\ No newline at end of file